@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 {
     'name': 'Add email configuration as individual user',
-    'version': '14.0.1.0.0',
+    'version': '14.0.1.1.0',
     'category': 'Tools',
     'website': "https://planet-odoo.com",
     'sequence': 1,
@@ -13,7 +13,11 @@
     "depends": ['base', 'mail'],
     "data": [
         'security/ir.model.access.csv',
+        'security/smtp_configuration_security.xml',
         'views/mail_server_settings.xml',
+        'views/ir_mail_server.xml',
+        'data/ir_cron_data.xml',
+        'wizard/smtp_metrics_report_views.xml',
     ],
     'images': [],
     'installable': True,
@@ -0,0 +1,231 @@
+"""Local stand-in SMTP server for the benchmarks.
+
+It speaks enough ESMTP for the module (EHLO/HELO, STARTTLS or implicit TLS,
+AUTH PLAIN/LOGIN, PIPELINING, SIZE, MAIL/RCPT/DATA, RSET, NOOP, QUIT), waits
+``latency`` seconds before each reply to mimic a remote provider, and counts
+what it receives. Messages are discarded.
+
+It can also be run on its own::
+
+    python -m benchmarks.fake_smtp --port 2525 --latency 0.05 --tls starttls
+"""
+import argparse
+import base64
+import os
+import re
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+
+def make_self_signed_cert(directory=None):
+    """Create a throw-away self-signed certificate for ``localhost`` with the
+    ``openssl`` command and return the ``(certfile, keyfile)`` paths."""
+    directory = directory or tempfile.mkdtemp(prefix='fake_smtp_')
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile,
+    ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+class FakeSMTPHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.sock = self.request
+        if self.server.tls == 'ssl':
+            self._wrap_tls()
+        self.reader = self.sock.makefile('rb')
+        self.authenticated = not self.server.users
+        self.in_transaction = False
+        self.recipients = 0
+
+    def _wrap_tls(self):
+        self.sock = self.server.ssl_context.wrap_socket(self.sock, server_side=True)
+        self.server.count('tls_handshakes')
+        if self.sock.session_reused:
+            self.server.count('tls_resumed')
+
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.sock.sendall(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.count('connections')
+        self.reply('220 localhost fake ESMTP')
+        while True:
+            line = self.reader.readline()
+            if not line:
+                return
+            command, _sep, args = line.decode('utf-8', 'replace').strip().partition(' ')
+            handler = getattr(self, 'smtp_' + command.upper(), None)
+            if handler is None:
+                self.reply('502 5.5.2 Command not recognized')
+            elif handler(args) is False:
+                return
+
+    def smtp_EHLO(self, args):
+        features = ['PIPELINING', '8BITMIME', 'SIZE %d' % self.server.max_size]
+        if self.server.tls == 'starttls' and not isinstance(self.sock, ssl.SSLSocket):
+            features.append('STARTTLS')
+        if self.server.users:
+            features.append('AUTH PLAIN LOGIN')
+        lines = ['localhost'] + features
+        for line in lines[:-1]:
+            self.sock.sendall(('250-%s\r\n' % line).encode('ascii'))
+        self.reply('250 %s' % lines[-1])
+
+    def smtp_HELO(self, args):
+        self.reply('250 localhost')
+
+    def smtp_STARTTLS(self, args):
+        if self.server.tls != 'starttls':
+            return self.reply('502 5.5.1 STARTTLS not available')
+        self.reply('220 2.0.0 Ready to start TLS')
+        self._wrap_tls()
+        self.reader = self.sock.makefile('rb')
+
+    def smtp_AUTH(self, args):
+        mechanism, _sep, initial = args.partition(' ')
+        mechanism = mechanism.upper()
+        if mechanism == 'PLAIN':
+            if not initial:
+                self.reply('334 ')
+                initial = self.reader.readline().strip().decode('ascii')
+            _authzid, user, password = base64.b64decode(initial).decode('utf-8').split('\0')
+        elif mechanism == 'LOGIN':
+            if initial:
+                user = base64.b64decode(initial).decode('utf-8')
+            else:
+                self.reply('334 VXNlcm5hbWU6')
+                user = base64.b64decode(self.reader.readline().strip()).decode('utf-8')
+            self.reply('334 UGFzc3dvcmQ6')
+            password = base64.b64decode(self.reader.readline().strip()).decode('utf-8')
+        else:
+            return self.reply('504 5.5.4 Unrecognized authentication type')
+        if self.server.users.get(user) == password or self.server.users.get('*') == password:
+            self.authenticated = True
+            self.server.count('logins')
+            self.reply('235 2.7.0 Authentication successful')
+        else:
+            self.reply('535 5.7.8 Authentication credentials invalid')
+
+    def smtp_MAIL(self, args):
+        if not self.authenticated:
+            return self.reply('530 5.7.0 Authentication required')
+        size = re.search(r'(?i)\bSIZE=(\d+)', args)
+        if size and int(size.group(1)) > self.server.max_size:
+            return self.reply('552 5.3.4 Message size exceeds fixed maximum message size')
+        self.in_transaction = True
+        self.recipients = 0
+        self.reply('250 2.1.0 OK')
+
+    def smtp_RCPT(self, args):
+        if not self.in_transaction:
+            return self.reply('503 5.5.1 Need MAIL before RCPT')
+        self.recipients += 1
+        self.reply('250 2.1.5 OK')
+
+    def smtp_DATA(self, args):
+        if not self.recipients:
+            return self.reply('503 5.5.1 Need RCPT before DATA')
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+        size = 0
+        for line in iter(self.reader.readline, b''):
+            if line == b'.\r\n':
+                break
+            size += len(line)
+        self.in_transaction = False
+        self.server.count('messages')
+        self.server.count('bytes', size)
+        self.reply('250 2.0.0 OK queued')
+
+    def smtp_RSET(self, args):
+        self.in_transaction = False
+        self.reply('250 2.0.0 OK')
+
+    def smtp_NOOP(self, args):
+        self.reply('250 2.0.0 OK')
+
+    def smtp_QUIT(self, args):
+        self.reply('221 2.0.0 Bye')
+        return False
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Threaded stand-in SMTP server.
+
+    :param float latency: seconds to wait before each reply
+    :param str tls: ``None``, ``'starttls'`` or ``'ssl'`` (implicit TLS)
+    :param dict users: accepted ``{user: password}`` pairs, AUTH is not offered
+                       when empty; the ``'*'`` user accepts any login with its password
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, tls=None, certfile=None, keyfile=None,
+                 users=None, max_size=100 * 1024 * 1024):
+        super().__init__((host, port), FakeSMTPHandler)
+        self.latency = latency
+        self.tls = tls
+        self.users = users or {}
+        self.max_size = max_size
+        self.ssl_context = None
+        if tls:
+            if not certfile:
+                certfile, keyfile = make_self_signed_cert()
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count(self, key, value=1):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-smtp', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds to wait before each reply")
+    parser.add_argument('--tls', choices=['starttls', 'ssl'])
+    parser.add_argument('--user', action='append', default=[], help="user:password accepted by AUTH")
+    args = parser.parse_args()
+    users = dict(user.split(':', 1) for user in args.user)
+    server = FakeSMTPServer(args.host, args.port, latency=args.latency, tls=args.tls, users=users)
+    print('listening on %s:%s' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats)
+
+
+if __name__ == '__main__':
+    main()
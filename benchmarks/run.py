@@ -0,0 +1,351 @@
+"""Throughput benchmarks of the module, run from an Odoo shell on a scratch database::
+
+    $ odoo shell -d bench_db --no-http <<'EOF'
+    from odoo.addons.smtp_configuration.benchmarks import run
+    run.main(env)                       # full scales, compared to baseline.json
+    run.main(env, scales=run.QUICK)     # smoke run
+    run.main(env, update_baseline=True) # record a new baseline
+    EOF
+
+Every scenario reports messages (or calls) per second, p50/p99 latency in
+milliseconds and the peak RSS of the process while it ran (the peak is reset
+before each measurement on Linux, elsewhere it is the peak since the process
+started). Records created by the
+scenarios are rolled back at the end. Results are compared to the saved
+baseline and a regression is reported when the throughput drops or the p99
+grows by more than ``TOLERANCE``.
+"""
+import json
+import os
+import resource
+import time
+
+import html2text
+
+from ..models.ir_mail_server import smtp_connection_pool
+from ..models.smtp_customize import Html2TextCache
+from .fake_smtp import FakeSMTPServer
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+TOLERANCE = 0.2
+
+HTML_BODY = '<div>%s</div>' % ''.join(
+    '<p>Paragraph <b>%d</b> of the newsletter, with a <a href="https://example.com/%d">link</a>.</p>' % (i, i)
+    for i in range(400)
+)
+
+SCALES = {
+    # (recipients, attachment size in MB) pairs for the message building scenarios
+    'build': [(1, 0), (1000, 0), (10000, 0), (100, 1), (10, 10), (2, 50)],
+    # number of messages sent through the fake server, and its reply latency in seconds
+    'send': [(1000, 0.0), (200, 0.01)],
+    # number of HTML bodies converted to text
+    'html2text': [1000],
+    # number of distinct per-user servers
+    'servers': [1, 50, 500],
+    # number of records of a mass-mail composer run
+    'composer_records': [1, 1000, 10000],
+    # number of fresh connections opened to the same TLS server
+    'reconnect': [200],
+    # number of users whose SMTP configuration is provisioned at once
+    'provisioning': [1000, 10000],
+}
+QUICK = {
+    'build': [(1, 0), (100, 0), (10, 1)],
+    'send': [(100, 0.0)],
+    'html2text': [100],
+    'servers': [1, 10],
+    'composer_records': [1, 100],
+    'reconnect': [20],
+    'provisioning': [100],
+}
+
+
+def _percentile(durations, q):
+    ordered = sorted(durations)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _start():
+    """Reset the peak RSS of the process to its current RSS and return the
+    start time of a measurement."""
+    try:
+        # Linux >= 4.0: "5" resets the VmHWM reported in /proc/self/status
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    return time.perf_counter()
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _result(durations, elapsed, count=None):
+    count = len(durations) if count is None else count
+    return {
+        'count': count,
+        'per_sec': round(count / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(_percentile(durations, 0.5) * 1000, 3),
+        'p99_ms': round(_percentile(durations, 0.99) * 1000, 3),
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _timed(calls):
+    """Run the callables of ``calls`` and return their durations and the total time."""
+    durations = []
+    start = _start()
+    for call in calls:
+        call_start = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - call_start)
+    return durations, time.perf_counter() - start
+
+
+def bench_build_email(env, recipients, attachment_mb):
+    """build_email() then serialization of the message of each recipient, without
+    then with the merge state of build_email_merge()."""
+    IrMailServer = env['ir.mail_server']
+    attachments = [('report.pdf', os.urandom(attachment_mb * 1024 * 1024), 'application/pdf')] if attachment_mb else None
+    targets = ['recipient%d@example.com' % i for i in range(recipients)]
+
+    def build(model, email_to):
+        return lambda: model.build_email(
+            'sender@example.com', [email_to], 'Newsletter', HTML_BODY, subtype='html', attachments=attachments,
+        ).as_bytes()
+    durations, elapsed = _timed(build(IrMailServer, email_to) for email_to in targets)
+    results = {'build_email': _result(durations, elapsed)}
+
+    # same calls through the merge state, as mail.mail does: each one builds the
+    # message (or copies it from the previous one) and serializes it
+    merging = IrMailServer.with_context(build_email_merge={})
+    durations, elapsed = _timed(build(merging, email_to) for email_to in targets)
+    results['build_email_merge'] = _result(durations, elapsed)
+    return results
+
+
+def bench_html2text(env, bodies):
+    """Convert ``bodies`` distinct HTML bodies with ``html2text`` directly, then
+    through an empty Html2TextCache (every lookup misses), then the same body
+    ``bodies`` times through it (every lookup but the first hits)."""
+    htmls = ['<h1>Newsletter %d</h1>%s' % (index, HTML_BODY) for index in range(bodies)]
+    results = {}
+    durations, elapsed = _timed(lambda html=html: html2text.html2text(html) for html in htmls)
+    results['html2text'] = _result(durations, elapsed)
+
+    cache = Html2TextCache()
+    durations, elapsed = _timed(lambda html=html: cache.html2text(html) for html in htmls)
+    results['html2text_cache_miss'] = _result(durations, elapsed)
+
+    cache = Html2TextCache()
+    durations, elapsed = _timed(lambda: cache.html2text(htmls[0]) for _index in range(bodies))
+    result = _result(durations, elapsed)
+    result['hit_rate'] = round(cache.stats()['hit_rate'], 3)
+    results['html2text_cache_hit'] = result
+    return results
+
+
+def bench_send(env, messages, latency):
+    """_connect() once, then build and send ``messages`` through the fake server."""
+    SmtpConfiguration = env['smtp.configuration']
+    with FakeSMTPServer(latency=latency, tls='starttls', users={'*': 'secret'}) as server:
+        connection = SmtpConfiguration._connect('127.0.0.1', server.port, 'bench@example.com', 'secret', 'starttls')
+
+        def send(index):
+            def _send():
+                msg = env['ir.mail_server'].build_email(
+                    'bench@example.com', ['recipient%d@example.com' % index], 'Newsletter', HTML_BODY, subtype='html')
+                connection.sendmail('bench@example.com', ['recipient%d@example.com' % index], msg.as_bytes())
+            return _send
+        durations, elapsed = _timed(send(index) for index in range(messages))
+        connection.quit()
+    return {'send': _result(durations, elapsed)}
+
+
+def bench_connect(env, servers):
+    """_connect() to ``servers`` distinct accounts, without then with the connection pool."""
+    SmtpConfiguration = env['smtp.configuration']
+    results = {}
+    with FakeSMTPServer(latency=0.001, tls='starttls', users={'*': 'secret'}) as server:
+        for pooled in (False, True):
+            def connect(index):
+                def _connect():
+                    connection = SmtpConfiguration._connect(
+                        '127.0.0.1', server.port, 'user%d@example.com' % index, 'secret', 'starttls', pooled=pooled)
+                    SmtpConfiguration._release_connection(connection)
+                return _connect
+            # two passes: the second one reuses the pooled connections
+            durations, elapsed = _timed(connect(index % servers) for index in range(servers * 2))
+            results['connect_pooled' if pooled else 'connect'] = _result(durations, elapsed)
+    # the pooled connections are to the stopped fake server
+    smtp_connection_pool.clear()
+    return results
+
+
+def bench_reconnect(env, connections):
+    """_connect() ``connections`` times to the same server by name, without pooling,
+    once with STARTTLS and once with implicit TLS. The DNS answer and the TLS
+    session of the first connection are reused by the next ones."""
+    SmtpConfiguration = env['smtp.configuration']
+    results = {}
+    for encryption, tls in (('starttls', 'starttls'), ('ssl', 'ssl')):
+        with FakeSMTPServer(latency=0.001, tls=tls, users={'*': 'secret'}) as server:
+            def connect():
+                connection = SmtpConfiguration._connect(
+                    'localhost', server.port, 'bench@example.com', 'secret', encryption)
+                connection.quit()
+            durations, elapsed = _timed(connect for _index in range(connections))
+            result = _result(durations, elapsed)
+            result['tls_resumed'] = server.stats.get('tls_resumed', 0)
+            results['reconnect_%s' % encryption] = result
+    return results
+
+
+def create_bench_users(env, count, prefix='bench_user'):
+    """Create ``count`` internal users with unique logins."""
+    return env['res.users'].with_context(no_reset_password=True).create([{
+        'name': 'Bench User %d/%d' % (i, count),
+        'login': '%s_%d_%d@example.com' % (prefix, i, count),
+        'email': '%s_%d_%d@example.com' % (prefix, i, count),
+        'groups_id': [(6, 0, [env.ref('base.group_user').id])],
+    } for i in range(count)])
+
+
+def create_routing_users(env, servers):
+    """Create ``servers`` users, each owning its own ``ir.mail_server``."""
+    users = create_bench_users(env, servers)
+    env['ir.mail_server'].create([{
+        'name': 'Bench Server %d/%d' % (i, servers),
+        'smtp_host': 'smtp%d.example.com' % i,
+        'smtp_port': 25,
+        'from_filter': 'example.com',
+        'log_user': user.id,
+    } for i, user in enumerate(users)])
+    return users
+
+
+def bench_provisioning(env, count):
+    """create(), confirm_smtp(), a reconcile run without drift, a reconcile run
+    after changing every configuration, then unlink() of the SMTP configurations
+    of ``count`` users, each as one batch."""
+    users = create_bench_users(env, count, prefix='bench_provisioned')
+    SmtpConfiguration = env['smtp.configuration'].sudo()
+    results = {}
+
+    def step(name, call):
+        start = _start()
+        call()
+        elapsed = time.perf_counter() - start
+        results['provisioning_%s' % name] = _result([elapsed], elapsed, count=count)
+
+    configurations = SmtpConfiguration.browse()
+
+    def create():
+        nonlocal configurations
+        configurations = SmtpConfiguration.create([{
+            'name': 'Bench SMTP %d' % i,
+            'smtp_host': 'smtp%d.example.com' % (i % 50),
+            'smtp_port': 587,
+            'smtp_encryption': 'starttls',
+            'smtp_user': user.login,
+            'smtp_pass': 'secret',
+            'smtp_log_user': user.id,
+        } for i, user in enumerate(users)])
+    step('create', create)
+    step('confirm', lambda: configurations.confirm_smtp())
+    step('sync', SmtpConfiguration._cron_sync_mail_servers)
+    configurations.write({'smtp_port': 465, 'smtp_encryption': 'ssl'})
+    step('sync_drift', SmtpConfiguration._cron_sync_mail_servers)
+    step('unlink', lambda: configurations.unlink())
+    return results
+
+
+def bench_composer_routing(env, users, records):
+    """get_mail_values() of a mass-mail composer run on ``records`` partners, once
+    for each of ``users``, which all have their own mail server."""
+    partners = env['res.partner'].create([{'name': 'Bench Partner %d' % i} for i in range(records)])
+
+    def compose(user):
+        def _compose():
+            composer = env['mail.compose.message'].with_user(user).with_context(
+                default_model='res.partner', default_composition_mode='mass_mail',
+            ).create({'subject': 'Newsletter', 'body': HTML_BODY})
+            composer.get_mail_values(partners.ids)
+        return _compose
+    durations, elapsed = _timed(compose(user) for user in users)
+    return {'composer_routing': _result(durations, elapsed, count=len(users) * records)}
+
+
+def run_all(env, scales=SCALES):
+    results = {}
+    for recipients, attachment_mb in scales['build']:
+        for name, result in bench_build_email(env, recipients, attachment_mb).items():
+            results['%s[recipients=%d,attachment_mb=%d]' % (name, recipients, attachment_mb)] = result
+    for bodies in scales['html2text']:
+        for name, result in bench_html2text(env, bodies).items():
+            results['%s[bodies=%d]' % (name, bodies)] = result
+    for messages, latency in scales['send']:
+        for name, result in bench_send(env, messages, latency).items():
+            results['%s[messages=%d,latency=%g]' % (name, messages, latency)] = result
+    for connections in scales['reconnect']:
+        for name, result in bench_reconnect(env, connections).items():
+            results['%s[connections=%d]' % (name, connections)] = result
+    for count in scales['provisioning']:
+        for name, result in bench_provisioning(env, count).items():
+            results['%s[users=%d]' % (name, count)] = result
+    for servers in scales['servers']:
+        for name, result in bench_connect(env, servers).items():
+            results['%s[servers=%d]' % (name, servers)] = result
+        users = create_routing_users(env, servers)
+        for records in scales['composer_records']:
+            for name, result in bench_composer_routing(env, users, records).items():
+                results['%s[servers=%d,records=%d]' % (name, servers, records)] = result
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Return the descriptions of the results regressing from ``baseline``."""
+    regressions = []
+    for key, result in sorted(results.items()):
+        reference = baseline.get(key)
+        if not reference:
+            continue
+        if result['per_sec'] < reference['per_sec'] * (1 - tolerance):
+            regressions.append('%s: %s/s instead of %s/s' % (key, result['per_sec'], reference['per_sec']))
+        if result['p99_ms'] > reference['p99_ms'] * (1 + tolerance):
+            regressions.append('%s: p99 %sms instead of %sms' % (key, result['p99_ms'], reference['p99_ms']))
+    return regressions
+
+
+def main(env, scales=SCALES, baseline_path=BASELINE_PATH, update_baseline=False):
+    try:
+        results = run_all(env, scales)
+    finally:
+        env.cr.rollback()
+
+    for key, result in sorted(results.items()):
+        print('%-60s %10.2f/s  p50 %9.3fms  p99 %9.3fms  rss %7.1fMB' % (
+            key, result['per_sec'], result['p50_ms'], result['p99_ms'], result['peak_rss_mb']))
+
+    if update_baseline or not os.path.exists(baseline_path):
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('baseline saved to %s' % baseline_path)
+        return results
+
+    with open(baseline_path) as f:
+        regressions = compare(results, json.load(f))
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    if not regressions:
+        print('no regression against %s' % baseline_path)
+    return results
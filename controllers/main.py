@@ -0,0 +1,17 @@
+from odoo import http
+from odoo.http import request
+
+from ..models import smtp_net
+from ..models.smtp_metrics import metrics
+
+
+class SmtpMetricsController(http.Controller):
+
+    @http.route('/smtp_configuration/metrics', type='http', auth='user', methods=['GET'])
+    def metrics(self, **kwargs):
+        """Prometheus text export of the send-path metrics, for administrators."""
+        if not request.env.user.has_group('base.group_system'):
+            return request.not_found()
+        return request.make_response(metrics.to_prometheus() + smtp_net.to_prometheus(), headers=[
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+        ])
@@ -0,0 +1,27 @@
+def migrate(cr, version):
+    """Link the mail servers created by the Confirm button before they were
+    tracked to their SMTP configuration, so the synchronization keeps managing
+    them, give them the required From filter, and confirm the configurations
+    whose user already has a mail server."""
+    cr.execute("""
+        UPDATE ir_mail_server s
+           SET smtp_configuration_id = c.id
+          FROM smtp_configuration c
+         WHERE s.smtp_configuration_id IS NULL
+           AND s.log_user = c.smtp_log_user
+           AND s.name = c.name
+           AND s.smtp_host = c.smtp_host
+           AND s.smtp_user = c.smtp_user
+    """)
+    cr.execute("""
+        UPDATE ir_mail_server
+           SET from_filter = smtp_user
+         WHERE smtp_configuration_id IS NOT NULL
+           AND from_filter IS NULL
+    """)
+    cr.execute("""
+        UPDATE smtp_configuration c
+           SET state = 'confirm'
+         WHERE state = 'draft'
+           AND EXISTS (SELECT 1 FROM ir_mail_server s WHERE s.log_user = c.smtp_log_user)
+    """)
@@ -1 +1,2 @@
 from . import smtp_customize
+from . import ir_mail_server
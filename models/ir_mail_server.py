@@ -1,32 +1,730 @@
 from email.message import EmailMessage
 from email.utils import make_msgid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import datetime
 import email
 import email.policy
+import hashlib
 import logging
+import random
 import re
 import smtplib
+import socket
 from socket import gaierror, timeout
+import ssl
 from ssl import SSLError
 import sys
 import threading
+import time
 
 import html2text
 import idna
 
 from odoo import api, fields, models, tools, _
-from odoo.exceptions import UserError
+from odoo.exceptions import UserError, ValidationError
+from odoo.addons.base.models.ir_mail_server import MailDeliveryException
 from odoo.tools import ustr, pycompat, formataddr
 
+from .smtp_metrics import metrics
+from .smtp_net import CachedSMTP, CachedSMTP_SSL
+from .smtp_spool import get_spool
+from .smtp_transport import MIN_PYTHON as ASYNCIO_MIN_PYTHON, AsyncSMTPConnection
+
 _logger = logging.getLogger(__name__)
 _test_logger = logging.getLogger('odoo.tests')
 
 SMTP_TIMEOUT = 60
+SMTP_POOL_IDLE_TTL = 300
+SMTP_POOL_MAX_PER_KEY = 4
+SMTP_CAPABILITIES_TTL = 3600
+# same preference order as smtplib.SMTP.login()
+SMTP_AUTH_MECHANISMS = ('CRAM-MD5', 'PLAIN', 'LOGIN')
+SMTP_HEALTH_DEADLINE = 15
+SMTP_HEALTH_WORKERS = 16
+SMTP_HEALTH_STAGES = [
+    ('dns', 'DNS'),
+    ('tcp', 'TCP'),
+    ('tls', 'TLS'),
+    ('auth', 'AUTH'),
+    ('mail', 'MAIL'),
+    ('rcpt', 'RCPT'),
+    ('data', 'DATA'),
+]
+# transient replies of providers throttling the sender
+SMTP_THROTTLE_CODES = (421, 451, 452)
+SMTP_BACKOFF_BASE = 30
+SMTP_BACKOFF_MAX = 3600
+SMTP_SPOOL_MAX_ATTEMPTS = 10
+# errors of the network rather than of the server configuration, worth a retry
+SMTP_TRANSIENT_ERRORS = (ConnectionError, timeout, gaierror, smtplib.SMTPServerDisconnected)
+SMTP_SPOOL_BATCH = 1000
+# mails whose attachments weigh more are sent with ir.mail_server.send_email_streamed()
+SMTP_STREAM_ATTACHMENT_SIZE = 10 * 1024 * 1024
+# smtp.configuration field -> ir.mail_server field kept in sync
+SMTP_SYNC_FIELDS = {
+    'name': 'name',
+    'smtp_host': 'smtp_host',
+    'smtp_port': 'smtp_port',
+    'smtp_encryption': 'smtp_encryption',
+    'smtp_user': 'smtp_user',
+    'smtp_pass': 'smtp_pass',
+}
+SMTP_HEALTH_FIELDS = ('health_state', 'health_stage', 'health_latency', 'health_message', 'health_date')
+
+
+class SmtpConnectionPool(object):
+    """Process-wide pool of authenticated SMTP connections.
+
+    Connections are keyed by ``(host, port, user, password hash, encryption,
+    transport)``. At most ``max_per_key`` connections of a key are open at
+    once, idle or in use: :meth:`acquire` waits for one to be released when
+    the limit is reached. Idle connections are checked with NOOP before being
+    handed out again and are evicted once they have been idle for more than
+    ``idle_ttl`` seconds.
+    """
+
+    def __init__(self, idle_ttl=SMTP_POOL_IDLE_TTL, max_per_key=SMTP_POOL_MAX_PER_KEY):
+        self.idle_ttl = idle_ttl
+        self.max_per_key = max_per_key
+        self._lock = threading.Condition()
+        self._idle = defaultdict(list)  # key -> [(connection, last_used)]
+        self._open = defaultdict(int)  # key -> connections open, idle or in use
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(host, port, user, password, encryption, transport):
+        password_hash = hashlib.sha256((password or '').encode('utf-8')).hexdigest()
+        return (host, port, user, password_hash, encryption, transport)
+
+    def acquire(self, key, max_wait=SMTP_TIMEOUT):
+        """Return a healthy idle connection for ``key``, or ``None`` when the
+        caller may open a new one. The new connection counts as open from then
+        on: it must be given to :meth:`release`, or to :meth:`discard` when it
+        could not be opened or is closed.
+
+        :raise socket.timeout: if all the connections of ``key`` stay in use
+                               for ``max_wait`` seconds
+        """
+        self._sweep()
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if idle:
+                    connection, last_used = idle.pop()
+                elif self._open[key] < self.max_per_key:
+                    self._open[key] += 1
+                    self.misses += 1
+                    return None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise timeout('All the %d SMTP connections to %s are in use' % (self.max_per_key, key[0]))
+                    self._lock.wait(remaining)
+                    continue
+            if time.monotonic() - last_used > self.idle_ttl or not self._is_alive(connection):
+                with self._lock:
+                    self.evictions += 1
+                self.discard(key, connection)
+                continue
+            with self._lock:
+                self.hits += 1
+            return connection
+
+    def release(self, key, connection):
+        """Give ``connection`` back to the pool, once reset to a clean state."""
+        try:
+            if connection.rset()[0] != 250:
+                raise smtplib.SMTPException('RSET refused')
+        except (smtplib.SMTPException, OSError):
+            self.discard(key, connection)
+            return
+        with self._lock:
+            self._idle[key].append((connection, time.monotonic()))
+            self._lock.notify()
+
+    def discard(self, key, connection=None):
+        """Close ``connection`` (if any) and free its slot of ``key``."""
+        with self._lock:
+            self._open[key] = max(self._open[key] - 1, 0)
+            if not self._open[key]:
+                del self._open[key]
+            self._lock.notify()
+        if connection is not None:
+            self._close(connection)
+
+    def clear(self, key=None):
+        """Close and forget the idle connections of ``key`` (all keys if not given)."""
+        with self._lock:
+            if key is None:
+                dropped = [(item_key, item) for item_key, idle in self._idle.items() for item in idle]
+                self._idle.clear()
+            else:
+                dropped = [(key, item) for item in self._idle.pop(key, [])]
+        for item_key, (connection, _last_used) in dropped:
+            self.discard(item_key, connection)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'open': sum(self._open.values()),
+            }
+
+    def _sweep(self):
+        """Evict the expired idle connections of every key, at most once per TTL."""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            if now - self._last_sweep < self.idle_ttl:
+                return
+            self._last_sweep = now
+            for key, idle in list(self._idle.items()):
+                alive = [item for item in idle if now - item[1] <= self.idle_ttl]
+                expired.extend((key, item[0]) for item in idle if now - item[1] > self.idle_ttl)
+                if alive:
+                    self._idle[key] = alive
+                else:
+                    del self._idle[key]
+            self.evictions += len(expired)
+        for key, connection in expired:
+            self.discard(key, connection)
+
+    @staticmethod
+    def _is_alive(connection):
+        try:
+            return connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+smtp_connection_pool = SmtpConnectionPool()
+
+
+class SmtpCapabilityCache(object):
+    """Capabilities negotiated with each configured SMTP server that a new
+    connection cannot learn from the EHLO reply: the AUTH mechanism that
+    succeeded. The extensions themselves (PIPELINING, SIZE...) are read from
+    the EHLO reply of each connection.
+
+    Entries are keyed by ``(model, record id)``, expire after ``ttl`` seconds
+    and carry a fingerprint of the host and credentials: an entry whose
+    fingerprint does not match the current configuration is ignored.
+    """
+
+    def __init__(self, ttl=SMTP_CAPABILITIES_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (fingerprint, expiry, capabilities)
+
+    @staticmethod
+    def fingerprint(*values):
+        return hashlib.sha256(repr(values).encode('utf-8')).hexdigest()
+
+    def get(self, key, fingerprint):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == fingerprint and entry[1] > time.monotonic():
+                return entry[2]
+            self._entries.pop(key, None)
+            return None
+
+    def set(self, key, fingerprint, capabilities):
+        with self._lock:
+            self._entries[key] = (fingerprint, time.monotonic() + self.ttl, capabilities)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+smtp_capability_cache = SmtpCapabilityCache()
+
+
+class SmtpHostLimiter(object):
+    """Caps the number of concurrent sessions and the session rate towards
+    one SMTP host, shared by all the send threads of the process.
+
+    :param int concurrency: maximum number of sessions open at the same time
+    :param int rate: maximum number of sessions started per minute (0 means unlimited)
+    """
+
+    def __init__(self, concurrency, rate=0):
+        self._semaphore = threading.BoundedSemaphore(max(concurrency, 1))
+        self._interval = 60.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        if self._interval:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + self._interval
+            if start > now:
+                time.sleep(start - now)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._semaphore.release()
+
+
+def probe_smtp_server(host, port, encryption, user, password, email_from, email_to, timeout, progress=None):
+    """Go through the stages of an SMTP delivery to ``host`` without sending anything:
+    DNS resolution, TCP connection, TLS negotiation, authentication, then MAIL FROM,
+    RCPT TO and the start of DATA.
+
+    :param float timeout: socket timeout of every network operation
+    :param dict progress: optional dict whose ``'stage'`` key is updated as the
+                          probe advances, so a caller giving up on it can tell
+                          where it was stuck
+    :return: dict with the ``state`` (``'ok'`` or ``'failed'``), the failed
+             ``stage`` (``False`` on success), the ``latency`` in milliseconds
+             and an error ``message``
+    """
+    progress = progress if progress is not None else {}
+    start = time.monotonic()
+    connection = None
+
+    def set_stage(stage):
+        progress['stage'] = stage
+
+    try:
+        set_stage('dns')
+        address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4]
+        set_stage('tcp')
+        sock = socket.create_connection(address[:2], timeout)
+        if encryption == 'ssl':
+            set_stage('tls')
+            sock = ssl._create_stdlib_context().wrap_socket(sock, server_hostname=host)
+        connection = smtplib.SMTP(timeout=timeout)
+        connection._host = host
+        connection.sock = sock
+        code, resp = connection.getreply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, resp)
+        if encryption == 'starttls':
+            set_stage('tls')
+            connection.starttls()
+        if user:
+            set_stage('auth')
+            local, at, domain = user.rpartition('@')
+            connection.login(f"{local}{at}{idna.encode(domain).decode('ascii')}", password or '')
+        set_stage('mail')
+        connection.ehlo_or_helo_if_needed()
+        code, resp = connection.mail(email_from)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, resp, email_from)
+        set_stage('rcpt')
+        code, resp = connection.rcpt(email_to)
+        if code not in (250, 251):
+            raise smtplib.SMTPRecipientsRefused({email_to: (code, resp)})
+        set_stage('data')
+        connection.putcmd('data')
+        code, resp = connection.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+    except Exception as e:
+        return {
+            'state': 'failed',
+            'stage': progress['stage'],
+            'latency': (time.monotonic() - start) * 1000,
+            'message': '%s: %s' % (e.__class__.__name__, ustr(e)),
+        }
+    finally:
+        if connection:
+            connection.close()
+    return {'state': 'ok', 'stage': False, 'latency': (time.monotonic() - start) * 1000, 'message': False}
+
+
+class SmtpTokenBucket(object):
+    """Token bucket of one mail server, adapting its rate to the throttling replies.
+
+    The configured ``rate`` (messages per minute, 0 for unlimited) is the ceiling:
+    each throttling reply halves the current rate and blocks the server for an
+    exponentially growing, jittered delay; each successful delivery raises the
+    current rate back by a tenth of the ceiling.
+    """
+
+    def __init__(self, rate, burst):
+        self.configure(rate, burst)
+        self.current_rate = self.rate
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.failures = 0
+        self.blocked_until = 0.0
+
+    def configure(self, rate, burst):
+        self.rate = float(rate or 0)
+        self.burst = max(burst or 1, 1)
+
+    def _refill(self, now):
+        if self.current_rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.current_rate / 60.0)
+        self.updated = now
+
+    def available(self, now):
+        """Return how many messages may be sent right now (None for unlimited)."""
+        if now < self.blocked_until:
+            return 0
+        if not self.rate:
+            return None
+        self._refill(now)
+        return int(self.tokens)
+
+    def consume(self, count):
+        if self.rate:
+            self.tokens = max(self.tokens - count, 0.0)
+
+    def succeeded(self):
+        self.failures = 0
+        if self.rate:
+            self.current_rate = min(self.rate, self.current_rate + self.rate / 10.0)
+
+    def throttled(self, now):
+        self.failures += 1
+        if self.rate:
+            self._refill(now)
+            self.current_rate = max(self.current_rate / 2.0, self.rate / 64.0)
+            self.tokens = 0.0
+        backoff = min(SMTP_BACKOFF_MAX, SMTP_BACKOFF_BASE * 2 ** (self.failures - 1))
+        self.blocked_until = now + backoff * random.uniform(0.5, 1.0)
+
+
+class SmtpRateLimiter(object):
+    """Token buckets of the mail servers of this process, keyed by ``(database name,
+    ir.mail_server ID)`` as the process may serve several databases."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _bucket(self, server_id, rate, burst):
+        bucket = self._buckets.get(server_id)
+        if bucket is None:
+            bucket = self._buckets[server_id] = SmtpTokenBucket(rate, burst)
+        else:
+            bucket.configure(rate, burst)
+        return bucket
+
+    def reserve(self, server_id, rate, burst, count):
+        """Take up to ``count`` tokens of ``server_id`` and return how many were granted."""
+        with self._lock:
+            bucket = self._bucket(server_id, rate, burst)
+            available = bucket.available(time.monotonic())
+            granted = count if available is None else min(count, available)
+            bucket.consume(granted)
+            return granted
+
+    def succeeded(self, server_id):
+        with self._lock:
+            bucket = self._buckets.get(server_id)
+            if bucket:
+                bucket.succeeded()
+
+    def throttled(self, server_id, rate=0, burst=1):
+        with self._lock:
+            self._bucket(server_id, rate, burst).throttled(time.monotonic())
+
+    def blocked_for(self, server_id):
+        """Return the seconds ``server_id`` still has to wait before sending."""
+        with self._lock:
+            bucket = self._buckets.get(server_id)
+            return max(bucket.blocked_until - time.monotonic(), 0.0) if bucket else 0.0
+
+    def state(self, server_id):
+        with self._lock:
+            bucket = self._buckets.get(server_id)
+            if not bucket:
+                return None
+            return {
+                'current_rate': bucket.current_rate,
+                'failures': bucket.failures,
+                'blocked_for': max(bucket.blocked_until - time.monotonic(), 0.0),
+            }
+
+
+smtp_rate_limiter = SmtpRateLimiter()
+
+
+def smtp_error_code(exception):
+    """Return the SMTP reply code at the origin of ``exception``, following the
+    exceptions it was raised from, or None."""
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        seen.add(id(exception))
+        if isinstance(exception, smtplib.SMTPResponseException):
+            return exception.smtp_code
+        if isinstance(exception, smtplib.SMTPRecipientsRefused) and exception.recipients:
+            return min(code for code, _resp in exception.recipients.values())
+        exception = exception.__cause__ or exception.__context__
+    return None
+
+
+def smtp_error_is_transient(exception):
+    """Return whether ``exception`` is worth retrying later: a 4xx reply of the
+    server, or a network error without any reply. The other ``smtplib`` errors
+    (no AUTH mechanism, extension not supported...) are ``OSError`` too, but
+    retrying them would fail the same way."""
+    code = smtp_error_code(exception)
+    if code:
+        return 400 <= code < 500
+    seen = set()
+    while exception is not None and id(exception) not in seen:
+        seen.add(id(exception))
+        if isinstance(exception, SMTP_TRANSIENT_ERRORS):
+            return True
+        exception = exception.__cause__ or exception.__context__
+    return False
+
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+
+def get_host_limiter(host, concurrency, rate=0):
+    """Return the process-wide limiter of ``host``, created on first use."""
+    with _host_limiters_lock:
+        limiter = _host_limiters.get(host)
+        if limiter is None:
+            limiter = _host_limiters[host] = SmtpHostLimiter(concurrency, rate)
+        return limiter
+
 
 class IrMailServer(models.Model):
     _inherit = 'ir.mail_server'
 
     log_user = fields.Many2one('res.users', string='User')
+    smtp_configuration_id = fields.Many2one('smtp.configuration', string='SMTP Configuration', readonly=True,
+                                            ondelete='set null', copy=False,
+                                            help="Configuration this server was created from and is kept in sync with.")
+
+    @api.model
+    @tools.ormcache('user_id')
+    def _get_user_mail_server_id(self, user_id):
+        """Return the ID of the mail server owned by ``user_id`` (False if none).
+        The result is kept in the registry cache, cleared (in every worker) when
+        a mail server or an SMTP configuration is modified."""
+        return self.sudo().search([('log_user', '=', user_id)], limit=1).id
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.clear_caches()
+        return super(IrMailServer, self).create(vals_list)
+
+    def write(self, vals):
+        self.clear_caches()
+        return super(IrMailServer, self).write(vals)
+
+    def unlink(self):
+        self.clear_caches()
+        return super(IrMailServer, self).unlink()
+
+    @api.model
+    @tools.ormcache('server_id')
+    def _get_smtp_configuration_id(self, server_id):
+        """Return the ID of the SMTP configuration the mail server was made from
+        (False if none)."""
+        return self.sudo().browse(server_id).smtp_configuration_id.id
+
+    @api.model
+    @tools.ormcache('server_id')
+    def _get_rate_limits(self, server_id):
+        """Return the ``(messages per minute, burst)`` limits of the mail server,
+        taken from the SMTP configuration of its user; ``(0, 1)`` when unlimited."""
+        configuration = self.env['smtp.configuration'].sudo().browse(self._get_smtp_configuration_id(server_id))
+        if not configuration:
+            return 0, 1
+        return configuration.smtp_rate_limit, configuration.smtp_rate_burst
+
+    @api.model
+    def _smtp_throttled(self, server_id):
+        """Make the rate limiter of the mail server back off, and store until when
+        on its SMTP configuration, so that every worker shows it. The date is
+        written in its own transaction: concurrent senders must not conflict."""
+        rate_key = (self.env.cr.dbname, server_id)
+        smtp_rate_limiter.throttled(rate_key, *self._get_rate_limits(server_id))
+        configuration_id = self._get_smtp_configuration_id(server_id)
+        if not configuration_id:
+            return
+        blocked_until = fields.Datetime.now() + datetime.timedelta(seconds=smtp_rate_limiter.blocked_for(rate_key))
+        try:
+            with self.pool.cursor() as cr:
+                cr.execute("""
+                    UPDATE smtp_configuration
+                       SET rate_blocked_until = %s
+                     WHERE id = %s
+                       AND (rate_blocked_until IS NULL OR rate_blocked_until < %s)
+                """, (blocked_until, configuration_id, blocked_until))
+        except Exception:
+            _logger.warning('Could not store the backoff of mail server ID #%s', server_id, exc_info=True)
+
+    def send_email(self, message, mail_server_id=None, smtp_server=None, smtp_port=None,
+                   smtp_user=None, smtp_password=None, smtp_encryption=None, smtp_debug=False,
+                   smtp_session=None):
+        """Feed the outcome of each delivery through a per-user server to its
+        rate limiter, so that throttling replies make it back off.
+
+        When the spool is enabled (``smtp_spool_dir`` option), a message the
+        server temporarily refuses is stored in the spool and delivered later
+        by :meth:`_cron_deliver_spool`; it is then reported as sent. Messages
+        whose attachments are streamed are not spooled."""
+        # a streamed message is built without its attachments, it cannot be spooled
+        streamed = (self.env.context.get('smtp_stream_attachments') or {}).get('ids')
+        spool = get_spool(self.env.cr.dbname) if not (smtp_server or smtp_user or streamed) else None
+        envelope = self._get_smtp_envelope(message) if spool else None
+        rate_key = (self.env.cr.dbname, mail_server_id)
+        try:
+            message_id = super(IrMailServer, self).send_email(
+                message, mail_server_id=mail_server_id, smtp_server=smtp_server, smtp_port=smtp_port,
+                smtp_user=smtp_user, smtp_password=smtp_password, smtp_encryption=smtp_encryption,
+                smtp_debug=smtp_debug, smtp_session=smtp_session)
+        except MailDeliveryException as e:
+            throttled = smtp_error_code(e) in SMTP_THROTTLE_CODES
+            if mail_server_id and throttled:
+                _logger.info('Mail server ID #%s is throttling, backing off', mail_server_id)
+                self._smtp_throttled(mail_server_id)
+            if not (spool and smtp_error_is_transient(e)):
+                raise
+            del message['Bcc']
+            delay = smtp_rate_limiter.blocked_for(rate_key) if mail_server_id and throttled else 0
+            spool.add(message.as_bytes(), mail_server_id, message['Message-Id'], envelope[0], envelope[1],
+                      time.time() + max(delay, SMTP_BACKOFF_BASE))
+            _logger.info('Mail server ID #%s temporarily refused %s, spooled for a later try',
+                         mail_server_id, message['Message-Id'])
+            return message['Message-Id']
+        if mail_server_id:
+            smtp_rate_limiter.succeeded(rate_key)
+        return message_id
+
+    @api.model
+    def _cron_deliver_spool(self, limit=SMTP_SPOOL_BATCH):
+        """Deliver the spooled messages whose next try is due, over one
+        connection per mail server, straight from the spool files."""
+        spool = get_spool(self.env.cr.dbname)
+        if spool is None:
+            return
+        if getattr(threading.currentThread(), 'testing', False) or self.env.registry.in_test_mode():
+            return
+        by_server = defaultdict(list)
+        for entry in spool.due()[:limit]:
+            by_server[entry['server']].append(entry)
+        try:
+            for server_id, entries in by_server.items():
+                self._deliver_spooled(spool, server_id, entries)
+        finally:
+            spool.flush()
+        spool.compact()
+
+    def _deliver_spooled(self, spool, server_id, entries):
+        now = time.time()
+        if server_id and not self.sudo().browse(server_id).exists():
+            for entry in entries:
+                self._spool_give_up(spool, entry, 'mail server #%s was deleted' % server_id)
+            return
+        rate_key = (self.env.cr.dbname, server_id)
+        blocked = smtp_rate_limiter.blocked_for(rate_key) if server_id else 0
+        if blocked:
+            for entry in entries:
+                spool.retry(entry, now + blocked, 'mail server is throttling', attempt=False)
+            return
+        try:
+            smtp_session = self.connect(mail_server_id=server_id or None)
+        except Exception as e:
+            _logger.info('Spool: cannot connect to mail server ID #%s: %s', server_id, e)
+            for entry in entries:
+                self._spool_failed(spool, entry, e)
+            return
+        try:
+            for index, entry in enumerate(entries):
+                if not spool.has_message(entry):
+                    # delivered, but the process died before its outcome was journaled
+                    spool.done(entry)
+                    continue
+                try:
+                    self._send_smtp_data(smtp_session, entry['from'], entry['to'], spool.iter_data(entry),
+                                         size=entry.get('size'))
+                except Exception as e:
+                    self._spool_failed(spool, entry, e)
+                    throttled = smtp_error_code(e) in SMTP_THROTTLE_CODES
+                    # refusals of this message only leave the session usable for the next ones
+                    refused = isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused))
+                    if throttled or not refused:
+                        # throttled or connection lost: leave the rest for the next run
+                        if server_id and throttled:
+                            self._smtp_throttled(server_id)
+                        delay = max(smtp_rate_limiter.blocked_for(rate_key) if server_id else 0, SMTP_BACKOFF_BASE)
+                        for rest in entries[index + 1:]:
+                            spool.retry(rest, now + delay, ustr(e), attempt=False)
+                        break
+                else:
+                    spool.done(entry)
+                    if server_id:
+                        smtp_rate_limiter.succeeded(rate_key)
+        finally:
+            try:
+                smtp_session.quit()
+            except Exception:
+                pass
+
+    def _spool_give_up(self, spool, entry, error):
+        """Move a spooled message to the failed ones and flag it as failed on the
+        ``mail.mail`` that sent it, or, as sent mails are usually deleted, on
+        the notifications of its recipients so it shows in the chatter."""
+        spool.fail(entry, error)
+        message_id = entry.get('message_id')
+        if not message_id:
+            return
+        mails = self.env['mail.mail'].sudo().search([('message_id', '=', message_id)])
+        if mails:
+            mails.write({'state': 'exception', 'failure_reason': error})
+            mails._postprocess_sent_message(success_pids=[], failure_reason=error, failure_type='SMTP')
+            return
+        recipients = {tools.email_normalize(address) for address in entry['to']}
+        notifications = self.env['mail.notification'].sudo().search([
+            ('mail_message_id.message_id', '=', message_id),
+            ('notification_type', '=', 'email'),
+        ]).filtered(lambda notification: tools.email_normalize(notification.res_partner_id.email) in recipients)
+        notifications.write({
+            'notification_status': 'exception',
+            'failure_type': 'SMTP',
+            'failure_reason': error,
+        })
+
+    def _spool_failed(self, spool, entry, exception):
+        """Schedule the next try of a spooled message, with an exponential
+        backoff, or give up on it after a permanent error or too many tries."""
+        error = '%s: %s' % (exception.__class__.__name__, ustr(exception))
+        attempts = entry['attempts'] + 1
+        if not smtp_error_is_transient(exception) or attempts >= SMTP_SPOOL_MAX_ATTEMPTS:
+            _logger.warning('Spool: giving up on message %s to %s after %d tries: %s',
+                            entry['id'], ', '.join(entry['to']), attempts, error)
+            self._spool_give_up(spool, entry, error)
+            return
+        backoff = min(SMTP_BACKOFF_MAX, SMTP_BACKOFF_BASE * 2 ** attempts)
+        spool.retry(entry, time.time() + backoff * random.uniform(0.5, 1.0), error)
+
 
 class SmtpConfiguration(models.Model):
     _name = 'smtp.configuration'
@@ -44,14 +742,58 @@ class SmtpConfiguration(models.Model):
     smtp_debug = fields.Boolean(string='Debugging', help="If enabled, the full output of SMTP sessions will "
                                                          "be written to the server log at DEBUG level "
                                                          "(this is very verbose and may include confidential info!)")
+    smtp_transport = fields.Selection([('smtplib', 'smtplib (blocking)'), ('asyncio', 'asyncio')],
+                                      string='Transport', required=True, default='smtplib',
+                                      help="Client implementation used to talk to the SMTP server.")
+    smtp_connect_timeout = fields.Integer('Connect Timeout', default=SMTP_TIMEOUT,
+                                          help="Seconds allowed to open the connection to the server.")
+    smtp_read_timeout = fields.Integer('Read Timeout', default=SMTP_TIMEOUT,
+                                       help="Seconds allowed to wait for each reply of the server.")
+    smtp_total_timeout = fields.Integer('Total Timeout', default=0,
+                                        help="Seconds allowed for a whole SMTP session, 0 for no limit "
+                                             "(asyncio transport only).")
 
     state = fields.Selection([
         ('draft', 'Draft'),
         ('confirm', 'Confirm'),
     ], string='Status', readonly=True, default='draft')
+    health_state = fields.Selection([
+        ('ok', 'OK'),
+        ('failed', 'Failed'),
+        ('timeout', 'Timed Out'),
+    ], string='Health', readonly=True, copy=False)
+    health_stage = fields.Selection(SMTP_HEALTH_STAGES, string='Failed Stage', readonly=True, copy=False)
+    health_latency = fields.Float('Latency (ms)', readonly=True, copy=False)
+    health_message = fields.Text('Health Message', readonly=True, copy=False)
+    health_date = fields.Datetime('Last Health Check', readonly=True, copy=False)
+    smtp_rate_limit = fields.Integer('Rate Limit', default=0,
+                                     help="Maximum number of messages sent per minute, 0 for no limit. "
+                                          "The effective rate is lowered automatically when the server "
+                                          "throttles (421/451/452 replies).")
+    smtp_rate_burst = fields.Integer('Burst', default=10,
+                                     help="Number of messages that can be sent at once before the rate limit applies.")
+    rate_state = fields.Selection([
+        ('idle', 'Normal'),
+        ('backoff', 'Backing Off'),
+    ], string='Throttling', compute='_compute_rate_state')
+    rate_current = fields.Float('Current Rate (msg/min)', compute='_compute_rate_state',
+                                help="Rate the worker process showing this form currently allows, "
+                                     "each worker process lowers its own rate when the server throttles.")
+    rate_blocked_until = fields.Datetime('Blocked Until', readonly=True, copy=False,
+                                         help="End of the last backoff asked by the server, in any worker process.")
+
+    @api.depends('rate_blocked_until')
+    def _compute_rate_state(self):
+        IrMailServer = self.env['ir.mail_server']
+        now = fields.Datetime.now()
+        for server in self:
+            server.rate_state = 'backoff' if server.rate_blocked_until and server.rate_blocked_until > now else 'idle'
+            state = smtp_rate_limiter.state(
+                (self.env.cr.dbname, IrMailServer._get_user_mail_server_id(server.smtp_log_user.id)))
+            server.rate_current = state['current_rate'] if state else server.smtp_rate_limit
 
-    def connect(self, host=None, port=None, user=None, password=None, encryption=None,
-                smtp_debug=False, mail_server_id=None):
+    def _connect(self, host=None, port=None, user=None, password=None, encryption=None,
+                 smtp_debug=False, mail_server_id=None, pooled=False):
         """Returns a new SMTP connection to the given SMTP server.
            When running in test mode, this method does nothing and returns `None`.
 
@@ -63,12 +805,20 @@ class SmtpConfiguration(models.Model):
            :param bool smtp_debug: toggle debugging of SMTP sessions (all i/o
                               will be output in logs)
            :param mail_server_id: ID of specific mail server to use (overrides other parameters)
+           :param bool pooled: reuse an authenticated connection from the process-wide
+                               pool when one is available, waiting for one when all the
+                               connections allowed for these credentials are in use; such
+                               connections must be given back with :meth:`_release_connection`
+                               instead of being closed
         """
         # Do not actually connect while running in test mode
         if getattr(threading.currentThread(), 'testing', False):
             return None
 
         mail_server = smtp_encryption = None
+        smtp_transport = 'smtplib'
+        connect_timeout = read_timeout = SMTP_TIMEOUT
+        total_timeout = 0
         if mail_server_id:
             mail_server = self.sudo().browse(mail_server_id)
         elif not host:
@@ -81,6 +831,10 @@ class SmtpConfiguration(models.Model):
             smtp_password = mail_server.smtp_pass
             smtp_encryption = mail_server.smtp_encryption
             smtp_debug = smtp_debug or mail_server.smtp_debug
+            smtp_transport = mail_server.smtp_transport or 'smtplib'
+            connect_timeout = mail_server.smtp_connect_timeout or SMTP_TIMEOUT
+            read_timeout = mail_server.smtp_read_timeout or SMTP_TIMEOUT
+            total_timeout = mail_server.smtp_total_timeout
         else:
             # we were passed individual smtp parameters or nothing and there is no default server
             smtp_server = host or tools.config.get('smtp_server')
@@ -97,17 +851,65 @@ class SmtpConfiguration(models.Model):
                  _("Please define at least one SMTP server, "
                    "or provide the SMTP parameters explicitly.")))
 
-        if smtp_encryption == 'ssl':
-            if 'SMTP_SSL' not in smtplib.__all__:
-                raise UserError(
-                    _("Your Odoo Server does not support SMTP-over-SSL. "
-                      "You could use STARTTLS instead. "
-                      "If SSL is needed, an upgrade to Python 2.6 on the server-side "
-                      "should do the trick."))
-            connection = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
-        else:
-            connection = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
+        pool_key = None
+        if pooled:
+            pool_key = smtp_connection_pool.key(smtp_server, smtp_port, smtp_user, smtp_password,
+                                                smtp_encryption, smtp_transport)
+            connection = smtp_connection_pool.acquire(pool_key, connect_timeout)
+            if connection:
+                connection.set_debuglevel(smtp_debug)
+                return connection
+            try:
+                connection = self._open_connection(
+                    mail_server, smtp_server, smtp_port, smtp_user, smtp_password, smtp_encryption,
+                    smtp_debug, smtp_transport, connect_timeout, read_timeout, total_timeout)
+            except Exception:
+                smtp_connection_pool.discard(pool_key)
+                raise
+            connection._smtp_pool_key = pool_key
+            return connection
+        return self._open_connection(
+            mail_server, smtp_server, smtp_port, smtp_user, smtp_password, smtp_encryption,
+            smtp_debug, smtp_transport, connect_timeout, read_timeout, total_timeout)
+
+    @api.constrains('smtp_transport')
+    def _check_smtp_transport(self):
+        if sys.version_info < ASYNCIO_MIN_PYTHON and 'asyncio' in self.mapped('smtp_transport'):
+            raise ValidationError(_("The asyncio transport requires Python %s.%s or later, "
+                                    "use the smtplib transport instead.", *ASYNCIO_MIN_PYTHON))
+
+    def _open_connection(self, mail_server, smtp_server, smtp_port, smtp_user, smtp_password, smtp_encryption,
+                         smtp_debug, smtp_transport, connect_timeout, read_timeout, total_timeout):
+        """Open, secure and authenticate a new connection for :meth:`_connect`."""
+        if smtp_encryption == 'ssl' and 'SMTP_SSL' not in smtplib.__all__:
+            raise UserError(
+                _("Your Odoo Server does not support SMTP-over-SSL. "
+                  "You could use STARTTLS instead. "
+                  "If SSL is needed, an upgrade to Python 2.6 on the server-side "
+                  "should do the trick."))
+        # DNS resolution, TCP connection (and SSL handshake) and greeting
+        with metrics.measure('tcp', smtp_server, self.env.uid):
+            if smtp_transport == 'asyncio':
+                connection = AsyncSMTPConnection(smtp_server, smtp_port, use_ssl=smtp_encryption == 'ssl',
+                                                 connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                                 total_timeout=total_timeout)
+            elif smtp_encryption == 'ssl':
+                connection = CachedSMTP_SSL(smtp_server, smtp_port, timeout=connect_timeout)
+                connection.sock.settimeout(read_timeout)
+            else:
+                connection = CachedSMTP(smtp_server, smtp_port, timeout=connect_timeout)
+                connection.sock.settimeout(read_timeout)
         connection.set_debuglevel(smtp_debug)
+        metrics.track_connection(connection, smtp_server, self.env.uid)
+        capability_key = capability_fingerprint = capabilities = None
+        if mail_server:
+            capability_key = (self._name, mail_server.id)
+            capability_fingerprint = smtp_capability_cache.fingerprint(
+                smtp_server, smtp_port, smtp_user, smtp_password, smtp_encryption)
+            capabilities = smtp_capability_cache.get(capability_key, capability_fingerprint)
+
+        with metrics.measure('ehlo', smtp_server, self.env.uid):
+            connection.ehlo_or_helo_if_needed()
         if smtp_encryption == 'starttls':
             # starttls() will perform ehlo() if needed first
             # and will discard the previous list of services
@@ -115,20 +917,77 @@ class SmtpConfiguration(models.Model):
             # (as per RFC 3207) so for example any AUTH
             # capability that appears only on encrypted channels
             # will be correctly detected for next step
-            connection.starttls()
+            with metrics.measure('tls', smtp_server, self.env.uid):
+                connection.starttls()
 
+        auth_mechanism = None
         if smtp_user:
             # Attempt authentication - will raise if AUTH service not supported
             local, at, domain = smtp_user.rpartition('@')
             domain = idna.encode(domain).decode('ascii')
-            connection.login(f"{local}{at}{domain}", smtp_password or '')
+            with metrics.measure('auth', smtp_server, self.env.uid):
+                auth_mechanism = self._smtp_login(connection, f"{local}{at}{domain}", smtp_password or '',
+                                                  capabilities and capabilities['auth_mechanism'])
 
         # Some methods of SMTP don't check whether EHLO/HELO was sent.
         # Anyway, as it may have been sent by login(), all subsequent usages should consider this command as sent.
         connection.ehlo_or_helo_if_needed()
 
+        if capability_key:
+            smtp_capability_cache.set(capability_key, capability_fingerprint, {
+                'auth_mechanism': auth_mechanism,
+            })
         return connection
 
+    @api.model
+    def _smtp_login(self, connection, user, password, auth_mechanism=None):
+        """Authenticate ``connection`` and return the AUTH mechanism that succeeded.
+
+        With ``smtplib`` connections, the mechanism remembered from a previous
+        connection is tried first, so the mechanisms the server rejects are not
+        attempted again; the other ones are tried in the order of
+        ``smtplib.SMTP.login()``. Other transports simply use their ``login()``.
+        """
+        if not isinstance(connection, smtplib.SMTP):
+            connection.login(user, password)
+            return None
+        connection.ehlo_or_helo_if_needed()
+        if not connection.has_extn('auth'):
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+        advertised = connection.esmtp_features['auth'].upper().split()
+        mechanisms = [mechanism for mechanism in SMTP_AUTH_MECHANISMS if mechanism in advertised]
+        if auth_mechanism in mechanisms:
+            mechanisms.remove(auth_mechanism)
+            mechanisms.insert(0, auth_mechanism)
+        if not mechanisms:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+        connection.user, connection.password = user, password
+        last_exception = None
+        for mechanism in mechanisms:
+            method = getattr(connection, 'auth_' + mechanism.lower().replace('-', '_'))
+            try:
+                code, resp = connection.auth(mechanism, method, initial_response_ok=True)
+            except smtplib.SMTPAuthenticationError as e:
+                last_exception = e
+                continue
+            if code in (235, 503):
+                return mechanism
+        raise last_exception
+
+    def _release_connection(self, connection):
+        """Give back a connection obtained from :meth:`_connect`. Pooled connections
+           are kept open for reuse, the other ones are closed."""
+        if not connection:
+            return
+        pool_key = getattr(connection, '_smtp_pool_key', None)
+        if pool_key:
+            smtp_connection_pool.release(pool_key, connection)
+        else:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+
     def test_smtp_connection(self):
         # mail_server = self.env['ir.mail_server'].sudo()
         # mail_server.test_smtp_connection()
@@ -136,7 +995,7 @@ class SmtpConfiguration(models.Model):
         for server in self:
             smtp = False
             try:
-                smtp = self.connect(mail_server_id=server.id)
+                smtp = self._connect(mail_server_id=server.id)
                 # simulate sending an email from current user's address - without sending it!
                 email_from, email_to = self.env.user.email, 'noreply@odoo.com'
                 if not email_from:
@@ -171,6 +1030,10 @@ class SmtpConfiguration(models.Model):
                     "The server has closed the connection unexpectedly. Check configuration served on this port number.\n %s",
                     ustr(e.strerror)))
             except smtplib.SMTPResponseException as e:
+                if e.smtp_code in SMTP_THROTTLE_CODES:
+                    mail_server_id = self.env['ir.mail_server']._get_user_mail_server_id(server.smtp_log_user.id)
+                    if mail_server_id:
+                        self.env['ir.mail_server']._smtp_throttled(mail_server_id)
                 raise UserError(_("Server replied with following exception:\n %s", ustr(e.smtp_error)))
             except smtplib.SMTPException as e:
                 raise UserError(_("An SMTP exception occurred. Check port number and connection security type.\n %s",
@@ -199,37 +1062,194 @@ class SmtpConfiguration(models.Model):
             }
         }
 
+    def action_check_smtp_health(self):
+        """Probe all the configurations of ``self`` concurrently and store the outcome
+           on them. The whole check is bounded by the ``smtp_configuration.health_deadline``
+           system parameter (seconds); the probes still running by then are recorded as
+           timed out at the stage they were in, the ones that did not start as timed
+           out without stage."""
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        deadline = float(get_param('smtp_configuration.health_deadline', SMTP_HEALTH_DEADLINE))
+        workers = int(get_param('smtp_configuration.health_workers', SMTP_HEALTH_WORKERS))
+        start = time.monotonic()
+
+        progress = {}
+        executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(self))))
+        futures = {}
+        for server in self.sudo():
+            email_from = server.smtp_log_user.email or self.env.user.email or server.smtp_user
+            progress[server.id] = {'stage': 'dns'}
+            futures[executor.submit(
+                probe_smtp_server, server.smtp_host, server.smtp_port, server.smtp_encryption,
+                server.smtp_user, server.smtp_pass, email_from, 'noreply@odoo.com', deadline,
+                progress[server.id],
+            )] = server.id
+        wait(futures, timeout=deadline)
+        # probes still queued are dropped, the running ones end on their own
+        # socket timeout: do not wait for them
+        not_started = {future for future in futures if future.cancel()}
+        executor.shutdown(wait=False)
+
+        now = fields.Datetime.now()
+        results = {}
+        for future, server_id in futures.items():
+            if future in not_started:
+                results[server_id] = {
+                    'state': 'timeout',
+                    'stage': False,
+                    'latency': 0.0,
+                    'message': _('Not started within %s seconds, too many servers for %s workers',
+                                 deadline, workers),
+                }
+            elif future.done():
+                results[server_id] = future.result()
+            else:
+                results[server_id] = {
+                    'state': 'timeout',
+                    'stage': progress[server_id]['stage'],
+                    'latency': (time.monotonic() - start) * 1000,
+                    'message': _('No answer within %s seconds', deadline),
+                }
+        for server in self:
+            result = results[server.id]
+            server.write({
+                'health_state': result['state'],
+                'health_stage': result['stage'],
+                'health_latency': result['latency'],
+                'health_message': result['message'],
+                'health_date': now,
+            })
+
+        failed = len([result for result in results.values() if result['state'] != 'ok'])
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _("Connection Check Done"),
+                'message': _("%s of %s servers OK", len(results) - failed, len(results)),
+                'type': 'warning' if failed else 'success',
+                'sticky': bool(failed),
+            }
+        }
+
     @api.model
-    def create(self, vals):
-        current_user = self.env.user.id
-        smtp_obj = self.env['smtp.configuration'].sudo().search([('create_uid', '=', current_user)], limit=1)
-        if smtp_obj:
-            raise UserError("You have already created the SMTP configuration.")
-        res = super(SmtpConfiguration, self).create(vals)
-        return res
+    def _cron_check_smtp_health(self):
+        self.search([('smtp_active', '=', True)]).action_check_smtp_health()
+
+    @api.model
+    def _cron_sync_mail_servers(self):
+        """Reconcile the mail servers created from SMTP configurations with them:
+        create the missing ones of confirmed configurations whose user has no
+        mail server, update the ones that drifted and delete the ones whose
+        configuration is gone or no longer confirmed. Mail servers linked to a
+        user by hand are left alone."""
+        configurations = {
+            configuration['id']: configuration
+            for configuration in self.sudo().search_read([('state', '=', 'confirm')],
+                                                         ['smtp_log_user'] + list(SMTP_SYNC_FIELDS))
+        }
+        mail_server = self.env['ir.mail_server'].sudo().with_context(active_test=False)
+        servers = mail_server.search_read([('log_user', '!=', False)],
+                                          ['log_user', 'smtp_configuration_id', 'from_filter']
+                                          + list(SMTP_SYNC_FIELDS.values()))
+        users_with_server = set()
+        to_unlink = []
+        to_write = defaultdict(list)  # frozen values -> server ids
+        seen = set()
+        for server in servers:
+            if not server['smtp_configuration_id']:
+                users_with_server.add(server['log_user'][0])
+                continue
+            configuration = configurations.get(server['smtp_configuration_id'][0])
+            if not configuration or configuration['id'] in seen:
+                to_unlink.append(server['id'])
+                continue
+            seen.add(configuration['id'])
+            users_with_server.add(server['log_user'][0])
+            diff = {
+                server_field: configuration[field]
+                for field, server_field in SMTP_SYNC_FIELDS.items()
+                if configuration[field] != server[server_field]
+            }
+            if configuration['smtp_log_user'] and configuration['smtp_log_user'][0] != server['log_user'][0]:
+                diff['log_user'] = configuration['smtp_log_user'][0]
+            if configuration['smtp_user'] != server['from_filter']:
+                diff['from_filter'] = configuration['smtp_user']
+            if diff:
+                to_write[frozenset(diff.items())].append(server['id'])
+        to_create = []
+        for configuration in configurations.values():
+            user_id = configuration['smtp_log_user'] and configuration['smtp_log_user'][0]
+            if user_id and configuration['id'] not in seen and user_id not in users_with_server:
+                users_with_server.add(user_id)
+                to_create.append(self._prepare_mail_server_values(configuration))
+
+        if to_unlink:
+            mail_server.browse(to_unlink).unlink()
+        for values, server_ids in to_write.items():
+            mail_server.browse(server_ids).write(dict(values))
+        if to_create:
+            mail_server.create(to_create)
+        _logger.info('Mail servers synchronized: %d created, %d updated, %d deleted',
+                     len(to_create), sum(len(ids) for ids in to_write.values()), len(to_unlink))
+
+    @api.model
+    def _prepare_mail_server_values(self, configuration):
+        """Return the values of the ``ir.mail_server`` of ``configuration``, a
+        record or a dict as returned by ``read()``. The server sends as the
+        account it authenticates with, its ``from_filter``."""
+        values = {server_field: configuration[field] for field, server_field in SMTP_SYNC_FIELDS.items()}
+        log_user = configuration['smtp_log_user']
+        values.update(active=True, log_user=log_user[0] if isinstance(log_user, tuple) else log_user.id,
+                      smtp_configuration_id=configuration['id'], from_filter=configuration['smtp_user'])
+        return values
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        user_ids = [vals['smtp_log_user'] if 'smtp_log_user' in vals else self.env.user.id for vals in vals_list]
+        duplicates = {user_id for user_id, count in Counter(user_ids).items() if user_id and count > 1}
+        groups = self.sudo().read_group([('smtp_log_user', 'in', [user_id for user_id in user_ids if user_id])],
+                                        ['smtp_log_user'], ['smtp_log_user'])
+        duplicates.update(group['smtp_log_user'][0] for group in groups)
+        if duplicates:
+            users = self.env['res.users'].sudo().browse(duplicates)
+            if users == self.env.user:
+                raise UserError(_("You have already created the SMTP configuration."))
+            raise UserError(_("An SMTP configuration already exists for: %s", ', '.join(users.mapped('name'))))
+        self.clear_caches()
+        return super(SmtpConfiguration, self).create(vals_list)
+
+    def write(self, vals):
+        if set(vals) - set(SMTP_HEALTH_FIELDS):
+            self.clear_caches()
+        if {'smtp_host', 'smtp_port', 'smtp_user', 'smtp_pass', 'smtp_encryption'} & set(vals):
+            for server in self:
+                smtp_capability_cache.invalidate((self._name, server.id))
+        return super(SmtpConfiguration, self).write(vals)
 
     def confirm_smtp(self):
+        """Create the mail servers of the users of the configurations, in a
+        single batch, and confirm the configurations. Users already having a
+        mail server keep it."""
         mail_server = self.env['ir.mail_server'].sudo()
-        mail_obj = mail_server.search([('log_user', '=', self.smtp_log_user.id)], limit=1)
-        if mail_obj:
-            pass
-        else:
-            mail_server.create({'name': self.name,
-                                'active': True,
-                                'smtp_host': self.smtp_host,
-                                'smtp_port': self.smtp_port,
-                                'log_user': self.smtp_log_user.id,
-                                'smtp_encryption': self.smtp_encryption,
-                                'smtp_user': self.smtp_user,
-                                'smtp_pass': self.smtp_pass
-                                })
-            self.write({'state': 'confirm'})
+        existing = {
+            server['log_user'][0]
+            for server in mail_server.search_read([('log_user', 'in', self.smtp_log_user.ids)], ['log_user'])
+        }
+        to_create = self.browse()
+        for configuration in self:
+            user_id = configuration.smtp_log_user.id
+            if user_id not in existing:
+                existing.add(user_id)
+                to_create |= configuration
+        if to_create:
+            mail_server.create([self._prepare_mail_server_values(configuration) for configuration in to_create])
+        self.write({'state': 'confirm'})
 
     def unlink(self):
-        mail_server = self.env['ir.mail_server'].sudo()
-        mail_obj = mail_server.search([('log_user', '=', self.smtp_log_user.id)], limit=1)
-        if mail_obj:
-            mail_obj.unlink()
+        self.env['ir.mail_server'].sudo().with_context(active_test=False).search(
+            [('smtp_configuration_id', 'in', self.ids)]).unlink()
+        self.clear_caches()
         return super(SmtpConfiguration, self).unlink()
 
 
@@ -238,13 +1258,203 @@ class MailComposerInherit(models.TransientModel):
     _inherit = 'mail.compose.message'
 
     def get_mail_values(self, res_ids):
+        """Send every generated mail through the mail server of the current user.
+        The server is resolved once for the whole batch of ``res_ids``."""
         res = super(MailComposerInherit, self).get_mail_values(res_ids)
-        mail_server_id_custom = self.env['ir.mail_server'].sudo().search([('log_user', '=', self.env.user.id)], limit=1)
-        strings = [str(integer) for integer in res_ids]
-        a_string = "".join(strings)
-        an_integer = int(a_string)
-
-        if mail_server_id_custom:
-            res[an_integer]['mail_server_id'] = mail_server_id_custom.id
-            # res.update({'mail_server_id': mail_server_id_custom.id})
-        return res
\ No newline at end of file
+        with metrics.measure('routing', user=self.env.uid):
+            mail_server_id = self.env['ir.mail_server']._get_user_mail_server_id(self.env.user.id)
+        if mail_server_id:
+            for values in res.values():
+                values['mail_server_id'] = mail_server_id
+        return res
+
+class IrAttachmentInherit(models.Model):
+
+    _inherit = 'ir.attachment'
+
+    def read(self, fields=None, load='_classic_read'):
+        """With the ``smtp_stream_attachments`` context (a dict) set by
+        ``mail.mail._send()``, the attachments read with their content are only
+        recorded in it under ``'ids'``, their content is read as False."""
+        stream = self.env.context.get('smtp_stream_attachments')
+        if stream is None or not fields or 'datas' not in fields:
+            return super(IrAttachmentInherit, self).read(fields=fields, load=load)
+        stream['ids'] = self.ids
+        result = super(IrAttachmentInherit, self).read(
+            fields=[field for field in fields if field != 'datas'], load=load)
+        for values in result:
+            values['datas'] = False
+        return result
+
+
+class MailMailInherit(models.Model):
+
+    _inherit = 'mail.mail'
+
+    def _send(self, auto_commit=False, raise_exception=False, smtp_session=None):
+        """Build the messages of the recipients of a mail from the one of the first
+        recipient when they only differ by their recipient headers, see
+        ``ir.mail_server._build_email_merged()``.
+
+        Mails whose attachments weigh more than the ``smtp_configuration.stream_attachment_size``
+        parameter (in bytes, 0 to disable) are sent one by one with the
+        ``smtp_stream_attachments`` context: their attachments are not loaded
+        by ``_send()``, see ``ir.attachment.read()``, and are streamed from the
+        filestore by ``ir.mail_server.send_email()``."""
+        threshold = int(self.env['ir.config_parameter'].sudo().get_param(
+            'smtp_configuration.stream_attachment_size', SMTP_STREAM_ATTACHMENT_SIZE))
+        streamed = self.browse()
+        if threshold > 0:
+            streamed = self.filtered(
+                lambda mail: mail.state == 'outgoing'
+                and sum(mail.attachment_ids.sudo().mapped('file_size')) > threshold)
+        others = self - streamed
+        if others:
+            super(MailMailInherit, others.with_context(build_email_merge={}))._send(
+                auto_commit=auto_commit, raise_exception=raise_exception, smtp_session=smtp_session)
+        for mail in streamed:
+            super(MailMailInherit, mail.with_context(build_email_merge={}, smtp_stream_attachments={}))._send(
+                auto_commit=auto_commit, raise_exception=raise_exception, smtp_session=smtp_session)
+        return True
+
+    def _split_by_server(self):
+        """Batch the mails by server, routed by :meth:`_route_by_server`, within
+        the rate limits of the servers. The tokens of the mails returned are
+        consumed: only call it when the batches are sent right away."""
+        return self._schedule_server_batches(self._route_by_server())
+
+    def _route_by_server(self):
+        """Route the queued mails that have no explicit server through the
+        ``ir.mail_server`` of the user who queued them before batching, so that
+        ``send()`` opens one SMTP session per user server instead of falling
+        back to the default server for every mail. Returns the ``(server_id,
+        mail_ids)`` batches of the parent implementation, without rate limits."""
+        unrouted = defaultdict(list)
+        # Only the server and the owner are needed, keep the prefetch minimal
+        # as in the parent implementation.
+        for mail in self.with_context(prefetch_fields=False):
+            if not mail.mail_server_id:
+                unrouted[mail.create_uid.id].append(mail.id)
+
+        if unrouted:
+            servers = self.env['ir.mail_server'].sudo().search([('log_user', 'in', list(unrouted))])
+            server_by_user = {}
+            for server in servers:
+                server_by_user.setdefault(server.log_user.id, server.id)
+            mails_by_server = defaultdict(list)
+            for user_id, mail_ids in unrouted.items():
+                if user_id in server_by_user:
+                    mails_by_server[server_by_user[user_id]].extend(mail_ids)
+            for server_id, mail_ids in mails_by_server.items():
+                self.browse(mail_ids).write({'mail_server_id': server_id})
+
+        return list(super(MailMailInherit, self)._split_by_server())
+
+    def _schedule_server_batches(self, batches):
+        """Apply the rate limits of the servers to the ``(server_id, mail_ids)`` batches.
+
+        Servers backing off after a throttling reply are skipped and the others are
+        sent first, the least throttled ones first; a batch is cut to the tokens its
+        server has left. The mails left out stay outgoing for the next queue run.
+        """
+        IrMailServer = self.env['ir.mail_server']
+        dbname = self.env.cr.dbname
+        batches = list(batches)
+        batches.sort(key=lambda batch: smtp_rate_limiter.blocked_for((dbname, batch[0])) if batch[0] else 0.0)
+        deferred = 0
+        for server_id, mail_ids in batches:
+            if not server_id:
+                yield server_id, mail_ids
+                continue
+            rate, burst = IrMailServer._get_rate_limits(server_id)
+            granted = smtp_rate_limiter.reserve((dbname, server_id), rate, burst, len(mail_ids))
+            deferred += len(mail_ids) - granted
+            if granted:
+                yield server_id, mail_ids[:granted]
+        if deferred:
+            _logger.info('Deferred %s emails of throttled mail servers to the next queue run', deferred)
+
+    def send(self, auto_commit=False, raise_exception=False):
+        """Send the server batches concurrently when the ``smtp_configuration.send_workers``
+        system parameter allows more than one worker.
+
+        Each batch runs in its own thread and cursor, so this only happens when
+        the caller lets us commit (``auto_commit``, as the mail queue cron does);
+        every other call keeps the sequential implementation. The sessions towards
+        one host are capped by ``smtp_configuration.host_concurrency`` and
+        ``smtp_configuration.host_rate`` (sessions per minute, 0 for no cap) so a
+        slow provider cannot take all the workers.
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_workers = int(get_param('smtp_configuration.send_workers', 1))
+        if (max_workers <= 1 or not auto_commit or raise_exception
+                or getattr(threading.currentThread(), 'testing', False)):
+            return super(MailMailInherit, self).send(auto_commit=auto_commit, raise_exception=raise_exception)
+
+        # routing only: super().send() reserves the tokens of its own batches
+        batches = self._route_by_server()
+        if len(batches) <= 1:
+            return super(MailMailInherit, self).send(auto_commit=auto_commit, raise_exception=raise_exception)
+        batches = list(self._schedule_server_batches(batches))
+        if not batches:
+            return True
+
+        host_concurrency = int(get_param('smtp_configuration.host_concurrency', 2))
+        host_rate = int(get_param('smtp_configuration.host_rate', 0))
+        server_ids = {server_id for server_id, _batch_ids in batches if server_id}
+        hosts = {server.id: server.smtp_host
+                 for server in self.env['ir.mail_server'].sudo().browse(server_ids)}
+
+        # the worker threads use their own cursors, they must see the routing
+        self._cr.commit()
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            futures = {
+                executor.submit(
+                    self._send_batch_in_thread, server_id, batch_ids,
+                    get_host_limiter(hosts.get(server_id), host_concurrency, host_rate),
+                ): server_id
+                for server_id, batch_ids in batches
+            }
+            for future in as_completed(futures):
+                if future.exception():
+                    _logger.error('Failed to send batch via mail server ID #%s: %s',
+                                  futures[future], future.exception())
+        self.invalidate_cache()
+        return True
+
+    def _send_batch_in_thread(self, server_id, batch_ids, limiter):
+        with api.Environment.manage(), self.pool.cursor() as cr:
+            env = api.Environment(cr, self.env.uid, self.env.context)
+            with limiter:
+                env['mail.mail'].browse(batch_ids)._send_server_batch(server_id)
+
+    def _send_server_batch(self, server_id):
+        """Send the mails of ``self`` over one session to ``server_id``, flagging the
+        whole batch in one write when the server cannot be reached.
+
+        The mail servers of the users go through the connection pool of their
+        SMTP configuration, so the next batches reuse the authenticated session."""
+        smtp_session = None
+        SmtpConfiguration = self.env['smtp.configuration'].sudo()
+        configuration_id = server_id and self.env['ir.mail_server']._get_smtp_configuration_id(server_id)
+        try:
+            if configuration_id:
+                smtp_session = SmtpConfiguration._connect(mail_server_id=configuration_id, pooled=True)
+            else:
+                smtp_session = self.env['ir.mail_server'].connect(mail_server_id=server_id)
+        except Exception as exc:
+            self.write({'state': 'exception', 'failure_reason': exc})
+            self._postprocess_sent_message(success_pids=[], failure_type="SMTP")
+            self._cr.commit()
+            return
+        try:
+            self._send(auto_commit=True, smtp_session=smtp_session)
+            _logger.info('Sent batch %s emails via mail server ID #%s', len(self), server_id)
+        finally:
+            if configuration_id:
+                SmtpConfiguration._release_connection(smtp_session)
+            elif smtp_session:
+                try:
+                    smtp_session.quit()
+                except (smtplib.SMTPException, OSError):
+                    smtp_session.close()
@@ -1,12 +1,23 @@
 from odoo import api, fields, models, tools, _
+from odoo.addons.base.models.ir_mail_server import MailDeliveryException
 from odoo.tools import ustr, pycompat, formataddr
+from .smtp_metrics import metrics
 from email.utils import getaddresses
 import logging
 from email.message import EmailMessage
 import email.policy
 from email.utils import make_msgid
 import html2text
+import base64
+from collections import OrderedDict
+import copy
 import datetime
+import functools
+import hashlib
+import mmap
+import smtplib
+import threading
+import uuid
 
 
 import re
@@ -16,6 +27,72 @@ import re
 
 address_pattern = re.compile(r'([^ ,<@]+@[^> ,]+)')
 _logger = logging.getLogger(__name__)
+_test_logger = logging.getLogger('odoo.tests')
+
+# multiple of 57 bytes, so that every chunk encodes to complete 76 chars base64 lines
+STREAM_CHUNK_SIZE = 57 * 1024
+HTML2TEXT_CACHE_MAX_ENTRIES = 512
+HTML2TEXT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+ADDRESS_CACHE_SIZE = 4096
+
+
+class Html2TextCache(object):
+    """Bounded LRU cache of ``html2text`` conversions, keyed by the SHA-256 of the
+    HTML so that large bodies are not kept as keys. The cache holds at most
+    ``max_entries`` texts and ``max_bytes`` bytes of (UTF-8 encoded) text; a
+    text larger than ``max_bytes`` is never cached.
+    """
+
+    def __init__(self, max_entries=HTML2TEXT_CACHE_MAX_ENTRIES, max_bytes=HTML2TEXT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # digest -> (text, size)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def html2text(self, html):
+        key = hashlib.sha256(html.encode('utf-8')).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        text = html2text.html2text(html)
+        size = len(text.encode('utf-8'))
+        if size > self.max_bytes:
+            return text
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (text, size)
+                self._size += size
+                while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                    _key, (_text, evicted_size) = self._entries.popitem(last=False)
+                    self._size -= evicted_size
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._size,
+            }
+
+
+html2text_cache = Html2TextCache()
 
 
 
@@ -57,6 +134,24 @@ def email_domain_extract(email):
     _, _, domain = email_split[0][1].rpartition('@')
     return domain
 
+def iter_base64_file(path, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield the base64 encoding of the file at ``path`` as CRLF terminated lines,
+    one chunk at a time. The file is memory-mapped when possible, so only one chunk
+    of it is held in memory at once."""
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # empty file, or a filesystem that does not support mapping
+            data = None
+        if data is None:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+            return
+        with data:
+            for offset in range(0, len(data), chunk_size):
+                yield base64.encodebytes(data[offset:offset + chunk_size]).replace(b'\n', b'\r\n')
+
 def extract_rfc2822_addresses(text):
     """Returns a list of valid RFC2822 addresses
        that can be found in ``source``, ignoring
@@ -67,6 +162,76 @@ def extract_rfc2822_addresses(text):
     candidates = address_pattern.findall(ustr(text))
     return [formataddr(('', c), charset='ascii') for c in candidates]
 
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def parse_address(text):
+    """Memoized ``getaddresses([text])``, as a tuple."""
+    return tuple(getaddresses([text]))
+
+
+class FromPolicy(object):
+    """The From and Return-Path rewriting of ``_get_email_from`` compiled for one
+    ``(force_smtp_from, dynamic_smtp_from, catchall_domain)`` configuration.
+
+    The replacement address is parsed once when the policy is built, senders are
+    parsed through :func:`parse_address` and the rewrite of each sender is
+    memoized, giving the same results as :func:`encapsulate_email`,
+    :func:`email_domain_extract` and :func:`extract_rfc2822_addresses`.
+    Use :func:`get_from_policy` to get the shared policy of a configuration.
+    """
+
+    def __init__(self, force_smtp_from, dynamic_smtp_from, catchall_domain):
+        self.catchall_domain = catchall_domain
+        if force_smtp_from:
+            self.mode, self.smtp_from = 'force', force_smtp_from
+        elif dynamic_smtp_from and catchall_domain:
+            self.mode, self.smtp_from = 'dynamic', dynamic_smtp_from
+        else:
+            self.mode, self.smtp_from = None, None
+        self.return_path = self.new_address = None
+        if self.mode:
+            rfc2822_smtp_from = extract_rfc2822_addresses(self.smtp_from)
+            self.return_path = rfc2822_smtp_from[0] if rfc2822_smtp_from else None
+            new_email_split = parse_address(self.smtp_from)
+            if new_email_split and new_email_split[0]:
+                self.new_address = new_email_split[0][1]
+        self.rewrite = functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)(self._rewrite)
+
+    def _rewrite(self, email_from):
+        if self.mode == 'force' or (self.mode == 'dynamic' and self._domain(email_from) != self.catchall_domain):
+            return self._encapsulate(email_from), self.return_path
+        return email_from, None
+
+    def rewrite_many(self, senders):
+        """Return the ``(from, return_path)`` pair of each of ``senders``, in order."""
+        return [self.rewrite(email_from) for email_from in senders]
+
+    def _encapsulate(self, email_from):
+        old_email_split = parse_address(email_from)
+        if not old_email_split or not old_email_split[0]:
+            return email_from
+        if self.new_address is None:
+            return None
+        if old_email_split[0][0]:
+            name_part = '%s (%s)' % old_email_split[0]
+        else:
+            name_part = old_email_split[0][1]
+        return formataddr((name_part, self.new_address))
+
+    @staticmethod
+    def _domain(email_from):
+        if not email_from:
+            return None
+        email_split = parse_address(email_from)
+        if not email_split or not email_split[0]:
+            return None
+        return email_split[0][1].rpartition('@')[2]
+
+
+@functools.lru_cache(maxsize=64)
+def get_from_policy(force_smtp_from, dynamic_smtp_from, catchall_domain):
+    return FromPolicy(force_smtp_from, dynamic_smtp_from, catchall_domain)
+
+
 class InheritIrMailServer(models.Model):
     _inherit = 'ir.mail_server'
 
@@ -103,6 +268,27 @@ class InheritIrMailServer(models.Model):
            :rtype: email.message.EmailMessage
            :return: the new RFC2822 email message
         """
+        with metrics.measure('build_email', self.smtp_host if len(self) == 1 else None, self.env.uid):
+            merge_state = self.env.context.get('build_email_merge')
+            if merge_state is not None:
+                return self._build_email_merged(merge_state, dict(
+                    email_to=email_to, email_cc=email_cc, email_bcc=email_bcc, message_id=message_id,
+                    references=references, object_id=object_id, headers=headers,
+                ), dict(
+                    email_from=email_from, subject=subject, body=body, reply_to=reply_to, attachments=attachments,
+                    subtype=subtype, body_alternative=body_alternative, subtype_alternative=subtype_alternative,
+                ))
+            return self._build_email(
+                email_from, email_to, subject, body, email_cc=email_cc, email_bcc=email_bcc, reply_to=reply_to,
+                attachments=attachments, message_id=message_id, references=references, object_id=object_id,
+                subtype=subtype, headers=headers, body_alternative=body_alternative,
+                subtype_alternative=subtype_alternative)
+
+    def _build_email(self, email_from, email_to, subject, body, email_cc=None, email_bcc=None, reply_to=False,
+                     attachments=None, message_id=None, references=None, object_id=False, subtype='plain',
+                     headers=None, body_alternative=None, subtype_alternative='plain'):
+        """Implementation of :meth:`build_email`, timed as a whole by it."""
+        server = self.smtp_host if len(self) == 1 else None
         email_from = email_from or self._get_default_from_address()
         _logger.info('email %s',email_from)
         assert email_from, "You must either provide a sender address explicitly or configure "\
@@ -127,7 +313,8 @@ class InheritIrMailServer(models.Model):
         if references:
             msg['references'] = references
         msg['Subject'] = subject
-        email_from, return_path = self._get_email_from(email_from)
+        with metrics.measure('routing', server, self.env.uid):
+            email_from, return_path = self._get_email_from(email_from)
         msg['From'] = email_from
         del msg['Reply-To']
         msg['Reply-To'] = reply_to or email_from
@@ -142,7 +329,9 @@ class InheritIrMailServer(models.Model):
 
         email_body = ustr(body)
         if subtype == 'html' and not body_alternative:
-            msg.add_alternative(html2text.html2text(email_body), subtype='plain', charset='utf-8')
+            with metrics.measure('html2text', server, self.env.uid):
+                text_body = html2text_cache.html2text(email_body)
+            msg.add_alternative(text_body, subtype='plain', charset='utf-8')
             msg.add_alternative(email_body, subtype=subtype, charset='utf-8')
         elif body_alternative:
             msg.add_alternative(ustr(body_alternative), subtype=subtype_alternative, charset='utf-8')
@@ -151,14 +340,299 @@ class InheritIrMailServer(models.Model):
             msg.set_content(email_body, subtype=subtype, charset='utf-8')
 
         if attachments:
-            for (fname, fcontent, mime) in attachments:
-                maintype, subtype = mime.split('/') if mime and '/' in mime else ('application', 'octet-stream')
-                msg.add_attachment(fcontent, maintype, subtype, filename=fname)
+            with metrics.measure('attachments', server, self.env.uid):
+                for (fname, fcontent, mime) in attachments:
+                    maintype, subtype = mime.split('/') if mime and '/' in mime else ('application', 'octet-stream')
+                    msg.add_attachment(fcontent, maintype, subtype, filename=fname)
         return msg
 
+    def build_email_merge(self, recipients, email_from, subject, body, reply_to=False, attachments=None,
+                          subtype='plain', body_alternative=None, subtype_alternative='plain'):
+        """Constructs one RFC2822 message per recipient of a mail merge sharing the same
+           sender, subject, bodies and attachments.
+
+           The first message is built with :meth:`build_email`, so the HTML to text
+           conversion, the encoding of the body parts and attachments and the folding
+           of the static headers are done once. Each following message is a copy of it
+           where only the per-recipient headers are replaced in place, which gives the
+           same bytes as calling :meth:`build_email` for that recipient. A recipient whose
+           set of headers differs from the previous one (e.g. an additional Cc) is built
+           from scratch and becomes the template of the next ones.
+
+           :param list recipients: list of dicts of the per-recipient keyword arguments of
+                                   :meth:`build_email`: ``email_to`` and optionally ``email_cc``,
+                                   ``email_bcc``, ``message_id``, ``references``, ``object_id``
+                                   and ``headers``
+                                   (the other arguments are shared by all recipients,
+                                   see :meth:`build_email`)
+           :rtype: list
+           :return: the email.message.EmailMessage of each recipient, in the same order
+        """
+        common = dict(email_from=email_from, subject=subject, body=body, reply_to=reply_to,
+                      attachments=attachments, subtype=subtype, body_alternative=body_alternative,
+                      subtype_alternative=subtype_alternative)
+        merge_state = {}
+        return [self._build_email_merged(merge_state, recipient, common) for recipient in recipients]
+
+    def _build_email_merged(self, merge_state, recipient, common):
+        """Builds the message of one recipient of a mail merge, see :meth:`build_email_merge`.
+
+           ``merge_state`` keeps a pristine copy of the last message built, used as the
+           template of the next recipients as long as the shared arguments ``common``
+           are the same (the attachments must be the very same list). It is also given
+           through the ``build_email_merge`` context key, so that the mails sent by
+           ``mail.mail`` to several recipients are built from the first one.
+        """
+        recipient_headers = self._build_email_recipient_headers(**recipient)
+        names = tuple(name.lower() for name, _value in recipient_headers)
+        template_common = merge_state.get('common')
+        if (merge_state.get('names') == names and template_common['attachments'] is common['attachments']
+                and all(template_common[key] == value for key, value in common.items())):
+            msg = copy.deepcopy(merge_state['template'])
+            for name, value in recipient_headers:
+                msg.replace_header(name, value)
+            return msg
+        msg = self._build_email(
+            email_to=recipient['email_to'], email_cc=recipient.get('email_cc'),
+            email_bcc=recipient.get('email_bcc'), references=recipient.get('references'),
+            message_id=recipient_headers[0][1], headers=recipient.get('headers'), **common)
+        # replace_header() only updates the first occurrence of a header
+        msg_names = [name.lower() for name in msg.keys()]
+        merge_state.clear()
+        if len(set(msg_names)) == len(msg_names):
+            # the caller may alter the message it gets (send_email() drops the Bcc)
+            merge_state.update(template=copy.deepcopy(msg), names=names, common=common)
+        return msg
+
+    def connect(self, host=None, port=None, user=None, password=None, encryption=None,
+                smtp_debug=False, mail_server_id=None):
+        connection = super(InheritIrMailServer, self).connect(
+            host=host, port=port, user=user, password=password, encryption=encryption,
+            smtp_debug=smtp_debug, mail_server_id=mail_server_id)
+        if metrics.enabled:
+            server = self.browse(mail_server_id).smtp_host if mail_server_id else host
+            metrics.track_connection(connection, server, self.env.uid)
+        return connection
+
+    def send_email(self, message, mail_server_id=None, smtp_server=None, smtp_port=None,
+                   smtp_user=None, smtp_password=None, smtp_encryption=None, smtp_debug=False,
+                   smtp_session=None):
+        """Same as the standard ``send_email``, except that with the
+           ``smtp_stream_attachments`` context of ``mail.mail._send()``, the attachments
+           it recorded are added to ``message`` while sending it, see
+           :meth:`send_email_streamed`."""
+        stream_ids = (self.env.context.get('smtp_stream_attachments') or {}).get('ids')
+        if not metrics.enabled:
+            if stream_ids:
+                return self._send_email_streamed(message, stream_ids, mail_server_id, smtp_session)
+            return super(InheritIrMailServer, self).send_email(
+                message, mail_server_id=mail_server_id, smtp_server=smtp_server, smtp_port=smtp_port,
+                smtp_user=smtp_user, smtp_password=smtp_password, smtp_encryption=smtp_encryption,
+                smtp_debug=smtp_debug, smtp_session=smtp_session)
+        # the bytes are counted by the connection, see connect()
+        server = self.browse(mail_server_id).smtp_host if mail_server_id else smtp_server
+        with metrics.measure('send', server, self.env.uid):
+            if stream_ids:
+                return self._send_email_streamed(message, stream_ids, mail_server_id, smtp_session)
+            return super(InheritIrMailServer, self).send_email(
+                message, mail_server_id=mail_server_id, smtp_server=smtp_server, smtp_port=smtp_port,
+                smtp_user=smtp_user, smtp_password=smtp_password, smtp_encryption=smtp_encryption,
+                smtp_debug=smtp_debug, smtp_session=smtp_session)
+
+    def _send_email_streamed(self, message, attachment_ids, mail_server_id=None, smtp_session=None):
+        """:meth:`send_email` of a message whose attachments are streamed: connects
+           to the mail server when no ``smtp_session`` is given, as ``send_email`` does."""
+        if getattr(threading.currentThread(), 'testing', False) or self.env.registry.in_test_mode():
+            _test_logger.info("skip sending email in test mode")
+            return message['Message-Id']
+        attachments = self.env['ir.attachment'].sudo().with_context(smtp_stream_attachments=None).browse(attachment_ids)
+        smtp = smtp_session
+        try:
+            smtp = smtp or self.connect(mail_server_id=mail_server_id)
+        except Exception as e:
+            msg = _("Mail delivery failed via SMTP server.\n%s: %s", e.__class__.__name__, ustr(e))
+            _logger.info(msg)
+            raise MailDeliveryException(_("Mail Delivery Failed"), msg)
+        try:
+            return self.browse(mail_server_id).send_email_streamed(message, attachments, smtp)
+        finally:
+            if not smtp_session:
+                try:
+                    smtp.quit()
+                except Exception:
+                    pass
+
+    def send_email_streamed(self, message, attachments, smtp_session):
+        """Sends ``message`` with the given ``ir.attachment`` records attached over an
+           already opened ``smtp_session``, without ever holding the whole MIME message
+           in memory.
+
+           ``message`` is built by :meth:`build_email` without attachments; it is turned
+           into a multipart/mixed message whose attachment parts are base64-encoded from
+           the filestore files chunk by chunk and written straight to the SMTP socket
+           during DATA, so the peak memory does not grow with the size of the attachments.
+           Attachments stored in database are encoded from their content.
+
+           :param message: the email.message.EmailMessage to send
+           :param attachments: ``ir.attachment`` recordset to attach
+           :param smtp_session: connection returned by :meth:`connect`
+           :return: the Message-ID of the message sent
+           :raise MailDeliveryException: if the message could not be delivered
+        """
+        smtp_from, smtp_to_list = self._get_smtp_envelope(message)
+        del message['Bcc']
+        message_id = message['Message-Id']
+
+        if getattr(threading.currentThread(), 'testing', False) or self.env.registry.in_test_mode():
+            _test_logger.info("skip sending email in test mode")
+            return message_id
+
+        try:
+            self._send_smtp_data(smtp_session, smtp_from, smtp_to_list,
+                                 self._iter_streamed_message(message, attachments),
+                                 size=self._estimate_streamed_size(message, attachments))
+        except Exception as e:
+            msg = _("Mail delivery failed via SMTP server.\n%s: %s", e.__class__.__name__, ustr(e))
+            _logger.info(msg)
+            raise MailDeliveryException(_("Mail Delivery Failed"), msg)
+        return message_id
+
+    def _get_smtp_envelope(self, message):
+        """Returns the ``(smtp_from, smtp_to_list)`` envelope of ``message``, the
+           same way as :meth:`send_email`, Bcc recipients included."""
+        smtp_from = message['Return-Path'] or self._get_default_bounce_address() or message['From']
+        from_rfc2822 = extract_rfc2822_addresses(smtp_from)
+        assert from_rfc2822, ("Malformed 'Return-Path' or 'From' address: %r - "
+                              "It should contain one valid plain ASCII email") % smtp_from
+        smtp_to_list = [address
+                        for base in [message['To'], message['Cc'], message['Bcc']]
+                        for address in extract_rfc2822_addresses(base)
+                        if address]
+        assert smtp_to_list, "At least one valid recipient address should be specified for outgoing emails (To/Cc/Bcc)"
+        return from_rfc2822[-1], smtp_to_list
+
+    def _send_smtp_data(self, smtp_session, smtp_from, smtp_to_list, chunks, size=None):
+        """Runs one mail transaction over ``smtp_session``: MAIL FROM and RCPT TO,
+           pipelined when the server offers PIPELINING, then DATA made of the
+           already dot-stuffed ``chunks``. Recipients refused by the server are
+           skipped, as long as one of them is accepted.
+
+           When the server offers SIZE (RFC 1870), the (estimated) ``size`` of the
+           message is declared in MAIL FROM, so a server whose limit it exceeds
+           refuses it before any byte of DATA is sent.
+
+           :raise smtplib.SMTPException: on a reply refusing the transaction
+        """
+        smtp_session.ehlo_or_helo_if_needed()
+        options = []
+        if size and smtp_session.has_extn('size'):
+            options.append('SIZE=%d' % size)
+        if smtp_session.has_extn('pipelining'):
+            # send MAIL FROM and all the RCPT TO at once, then read the replies
+            smtp_session.putcmd('mail', 'FROM:<%s>%s' % (smtp_from, ''.join(' ' + o for o in options)))
+            for address in smtp_to_list:
+                smtp_session.putcmd('rcpt', 'TO:<%s>' % address)
+            code, resp = smtp_session.getreply()
+            replies = [smtp_session.getreply() for _address in smtp_to_list]
+        else:
+            code, resp = smtp_session.mail(smtp_from, options)
+            replies = [smtp_session.rcpt(address) for address in smtp_to_list] if code == 250 else []
+        if code != 250:
+            smtp_session.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, smtp_from)
+        refused = {address: reply for address, reply in zip(smtp_to_list, replies) if reply[0] not in (250, 251)}
+        if len(refused) == len(smtp_to_list):
+            smtp_session.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = smtp_session.docmd('data')
+        if code != 354:
+            smtp_session.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        server = self.smtp_host if len(self) == 1 else None
+        with metrics.measure('data', server, self.env.uid):
+            for chunk in chunks:
+                smtp_session.send(chunk)
+                metrics.add_bytes(len(chunk), server, self.env.uid)
+            smtp_session.send(b'.\r\n')
+            code, resp = smtp_session.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def _estimate_streamed_size(self, message, attachments):
+        """Returns about the number of bytes :meth:`_iter_streamed_message` yields:
+           the message itself, plus the base64 lines (76 characters and CRLF for
+           57 bytes) and part headers of the attachments."""
+        size = len(message.as_bytes())
+        for attachment in attachments:
+            size += -(-(attachment.file_size or 0) // 57) * 78 + 256
+        return size
+
+    def _iter_streamed_message(self, message, attachments):
+        """Yield the dot-stuffed DATA bytes of ``message`` followed by one
+           base64-encoded part per attachment record."""
+        boundary = '=' * 15 + uuid.uuid4().hex + '=='
+        message.make_mixed()
+        message.set_boundary(boundary)
+        head = message.as_bytes()
+        # drop the closing delimiter, the attachment parts go before it
+        head = head[:head.rindex(b'--%s--' % boundary.encode('ascii'))]
+        yield re.sub(br'(?m)^\.', b'..', head)
+
+        for attachment in attachments:
+            mime = attachment.mimetype
+            maintype, subtype = mime.split('/') if mime and '/' in mime else ('application', 'octet-stream')
+            part = EmailMessage(policy=email.policy.SMTP)
+            part['Content-Type'] = '%s/%s' % (maintype, subtype)
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=attachment.name)
+            part.set_payload('')
+            yield b'--%s\r\n' % boundary.encode('ascii') + part.as_bytes()
+            if attachment.store_fname:
+                yield from iter_base64_file(attachment._full_path(attachment.store_fname))
+            else:
+                yield base64.encodebytes(attachment.raw or b'').replace(b'\n', b'\r\n')
+        yield b'--%s--\r\n' % boundary.encode('ascii')
+
+    def _build_email_recipient_headers(self, email_to, email_cc=None, email_bcc=None, message_id=None,
+                                       references=None, object_id=False, headers=None):
+        """Return the ``(name, value)`` pairs of the headers that :meth:`build_email`
+           sets from its per-recipient arguments, Message-Id first."""
+        if not message_id:
+            if object_id:
+                message_id = tools.generate_tracking_message_id(object_id)
+            else:
+                message_id = make_msgid()
+        recipient_headers = [('Message-Id', message_id)]
+        if references:
+            recipient_headers.append(('references', references))
+        recipient_headers.append(('To', email_to))
+        if email_cc:
+            recipient_headers.append(('Cc', email_cc))
+        if email_bcc:
+            recipient_headers.append(('Bcc', email_bcc))
+        recipient_headers.append(('Date', datetime.datetime.utcnow()))
+        for key, value in (headers or {}).items():
+            recipient_headers.append((pycompat.to_text(ustr(key)), value))
+        return recipient_headers
+
 
 
 
+    @api.model
+    @tools.ormcache()
+    def _get_email_from_params(self):
+        """Return the ``(force_smtp_from, dynamic_smtp_from, catchall_domain)`` values
+        used by :meth:`_get_email_from`. They are kept in the registry cache, which
+        is cleared in every worker when a mail server or a system parameter is written.
+        The forced From comes from the shared servers: the servers of a user
+        (``log_user``) only send the mails of that user."""
+        # force_smtp_from = self.env['ir.config_parameter'].sudo().get_param('mail.force.smtp.from')
+        force_smtp_from = self.env['ir.mail_server'].sudo().search(
+            [('active', '=', True), ('log_user', '=', False)], limit=1).from_filter
+        dynamic_smtp_from = self.env['ir.config_parameter'].sudo().get_param('mail.dynamic.smtp.from')
+        catchall_domain = self.env['ir.config_parameter'].sudo().get_param('mail.catchall.domain')
+        return force_smtp_from, dynamic_smtp_from, catchall_domain
+
     def _get_email_from(self, email_from):
         """Logic which determines which email to use when sending the email.
 
@@ -172,20 +646,4 @@ class InheritIrMailServer(models.Model):
         :param email_from: The initial FROM headers
         :return: The FROM to used in the headers and optionally the Return-Path
         """
-        # force_smtp_from = self.env['ir.config_parameter'].sudo().get_param('mail.force.smtp.from')
-        force_smtp_from = self.env['ir.mail_server'].sudo().search([('active', '=', True)], limit=1).from_filter
-        _logger.info("Recording Uploaded Webhook Response Received Successfully")
-        dynamic_smtp_from = self.env['ir.config_parameter'].sudo().get_param('mail.dynamic.smtp.from')
-        catchall_domain = self.env['ir.config_parameter'].sudo().get_param('mail.catchall.domain')
-
-        if force_smtp_from:
-            rfc2822_force_smtp_from = extract_rfc2822_addresses(force_smtp_from)
-            rfc2822_force_smtp_from = rfc2822_force_smtp_from[0] if rfc2822_force_smtp_from else None
-            return encapsulate_email(email_from, force_smtp_from), rfc2822_force_smtp_from
-
-        elif dynamic_smtp_from and catchall_domain and email_domain_extract(email_from) != catchall_domain:
-            rfc2822_dynamic_smtp_from = extract_rfc2822_addresses(dynamic_smtp_from)
-            rfc2822_dynamic_smtp_from = rfc2822_dynamic_smtp_from[0] if rfc2822_dynamic_smtp_from else None
-            return encapsulate_email(email_from, dynamic_smtp_from), rfc2822_dynamic_smtp_from
-
-        return email_from, None
+        return get_from_policy(*self._get_email_from_params()).rewrite(email_from)
@@ -0,0 +1,288 @@
+"""Timing histograms and byte counters of the send path.
+
+Instrumentation is off unless the ``smtp_metrics`` option is set in the server
+configuration file; when off, :meth:`SmtpMetrics.measure` hands out a shared
+no-op timer, so the instrumented code only pays an attribute lookup.
+
+Each process records in memory, and dumps its counters every
+``DUMP_INTERVAL`` seconds to ``<pid>.json`` in the ``smtp_metrics_dir``
+directory (``<data_dir>/smtp_metrics`` by default), like the multiprocess
+mode of the Prometheus client. The summaries and the export add up the files
+of all the processes, so with prefork workers the HTTP worker serving them
+also reports what the cron workers sent, at most ``DUMP_INTERVAL`` seconds
+late. The files of stopped processes are kept, their counters still count.
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from odoo.tools import config
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DUMP_INTERVAL = 5
+
+
+class _NoopTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_noop_timer = _NoopTimer()
+
+
+class _Timer(object):
+
+    __slots__ = ('metrics', 'stage', 'server', 'user', 'start')
+
+    def __init__(self, metrics, stage, server, user):
+        self.metrics = metrics
+        self.stage = stage
+        self.server = server
+        self.user = user
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.server, self.user)
+        return False
+
+
+class SmtpMetrics(object):
+    """Per-stage latency histograms and byte counters, labelled by mail server
+    and user."""
+
+    def __init__(self, enabled=False, directory=None):
+        self.enabled = enabled
+        self.directory = directory
+        self._lock = threading.Lock()
+        # (stage, server, user) -> [count per bucket..., count in +Inf bucket]
+        self._buckets = {}
+        self._sums = defaultdict(float)
+        self._bytes = defaultdict(int)  # (server, user) -> bytes sent
+        self._changed = False
+        self._reset_at = 0.0  # last reset of all the processes applied to this one
+        self._dumper_pid = None
+
+    def measure(self, stage, server=None, user=None):
+        """Return a context manager recording the time spent in its block."""
+        if not self.enabled:
+            return _noop_timer
+        return _Timer(self, stage, server, user)
+
+    def observe(self, stage, seconds, server=None, user=None):
+        if not self.enabled:
+            return
+        key = (stage, str(server or 'default'), str(user or ''))
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                buckets = self._buckets[key] = [0] * (len(BUCKETS) + 1)
+            buckets[index] += 1
+            self._sums[key] += seconds
+            self._changed_locked()
+
+    def add_bytes(self, nbytes, server=None, user=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._bytes[(str(server or 'default'), str(user or ''))] += nbytes
+            self._changed_locked()
+
+    def track_connection(self, connection, server=None, user=None):
+        """Count the bytes of the messages sent through ``connection.sendmail()``,
+        which ``send_message()`` calls with the message it flattened, so that
+        the message is not serialized a second time to be measured."""
+        if not self.enabled or getattr(connection, '_metrics_tracked', False):
+            return
+        sendmail = connection.sendmail
+
+        def tracked_sendmail(from_addr, to_addrs, msg, *args, **kwargs):
+            result = sendmail(from_addr, to_addrs, msg, *args, **kwargs)
+            self.add_bytes(len(msg), server, user)
+            return result
+
+        connection.sendmail = tracked_sendmail
+        connection._metrics_tracked = True
+
+    def _changed_locked(self):
+        self._changed = True
+        if self.directory and self._dumper_pid != os.getpid():
+            # first record of this process: threads do not survive a fork, and
+            # the resets done before do not apply to what it records
+            self._dumper_pid = os.getpid()
+            try:
+                self._reset_at = max(self._reset_at, os.path.getmtime(self._reset_path()))
+            except OSError:
+                pass
+            threading.Thread(target=self._dump_loop, name='smtp-metrics', daemon=True).start()
+
+    def _dump_loop(self):
+        pid = os.getpid()
+        while self._dumper_pid == pid:
+            time.sleep(DUMP_INTERVAL)
+            try:
+                self.dump()
+            except OSError:
+                pass
+
+    def _reset_path(self):
+        return os.path.join(self.directory, 'reset')
+
+    def _apply_reset_locked(self):
+        """Forget the counters recorded before the last reset of another process."""
+        try:
+            reset_at = os.path.getmtime(self._reset_path())
+        except OSError:
+            return
+        if reset_at > self._reset_at:
+            self._reset_at = reset_at
+            self._buckets.clear()
+            self._sums.clear()
+            self._bytes.clear()
+
+    def dump(self):
+        """Write the counters of this process to its file of the shared directory."""
+        if not self.directory:
+            return
+        with self._lock:
+            self._apply_reset_locked()
+            if not self._changed:
+                return
+            data = {
+                'buckets': [list(key) + [buckets, self._sums[key]] for key, buckets in self._buckets.items()],
+                'bytes': [list(key) + [nbytes] for key, nbytes in self._bytes.items()],
+            }
+            self._changed = False
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    def _collect(self):
+        """Return the histograms ``{key: (buckets, sum)}`` and the byte counters
+        ``{key: bytes}`` of all the processes."""
+        with self._lock:
+            if self.directory:
+                self._apply_reset_locked()
+            items = {key: (list(buckets), self._sums[key]) for key, buckets in self._buckets.items()}
+            sent = dict(self._bytes)
+        if not self.directory:
+            return items, sent
+        own = os.path.join(self.directory, '%d.json' % os.getpid())
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for stage, server, user, buckets, total in data['buckets']:
+                key = (stage, server, user)
+                if key in items:
+                    items[key] = ([a + b for a, b in zip(items[key][0], buckets)], items[key][1] + total)
+                else:
+                    items[key] = (buckets, total)
+            for server, user, nbytes in data['bytes']:
+                sent[(server, user)] = sent.get((server, user), 0) + nbytes
+        return items, sent
+
+    def reset(self):
+        """Reset the counters of all the processes."""
+        with self._lock:
+            self._buckets.clear()
+            self._sums.clear()
+            self._bytes.clear()
+            if not self.directory:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._reset_path(), 'w'):
+                pass
+            self._reset_at = os.path.getmtime(self._reset_path())
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def summary(self):
+        """Return one dict per (stage, server, user) with the count, the average
+        and the approximate p50/p99 (upper bound of the bucket), in seconds, of
+        all the processes."""
+        items = [(key, buckets, total) for key, (buckets, total) in self._collect()[0].items()]
+        lines = []
+        for (stage, server, user), buckets, total in sorted(items):
+            count = sum(buckets)
+            lines.append({
+                'stage': stage,
+                'server': server,
+                'user': user,
+                'count': count,
+                'avg': total / count if count else 0.0,
+                'p50': _quantile(buckets, count, 0.5),
+                'p99': _quantile(buckets, count, 0.99),
+            })
+        return lines
+
+    def bytes_summary(self):
+        return sorted(self._collect()[1].items())
+
+    def to_prometheus(self):
+        """Return the metrics of all the processes in the Prometheus text exposition format."""
+        items, sent = self._collect()
+        items = sorted((key, buckets, total) for key, (buckets, total) in items.items())
+        sent = sorted(sent.items())
+        out = [
+            '# HELP smtp_stage_duration_seconds Time spent in each stage of the send path.',
+            '# TYPE smtp_stage_duration_seconds histogram',
+        ]
+        for (stage, server, user), buckets, total in items:
+            labels = 'stage="%s",server="%s",user="%s"' % (_escape(stage), _escape(server), _escape(user))
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += count
+                out.append('smtp_stage_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            out.append('smtp_stage_duration_seconds_sum{%s} %.6f' % (labels, total))
+            out.append('smtp_stage_duration_seconds_count{%s} %d' % (labels, cumulative))
+        out += [
+            '# HELP smtp_sent_bytes_total Bytes of messages sent.',
+            '# TYPE smtp_sent_bytes_total counter',
+        ]
+        for (server, user), nbytes in sent:
+            out.append('smtp_sent_bytes_total{server="%s",user="%s"} %d' % (_escape(server), _escape(user), nbytes))
+        return '\n'.join(out) + '\n'
+
+
+def _quantile(buckets, count, q):
+    if not count:
+        return 0.0
+    rank = q * count
+    cumulative = 0
+    for bound, bucket_count in zip(BUCKETS, buckets):
+        cumulative += bucket_count
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = SmtpMetrics(
+    enabled=bool(config.get('smtp_metrics')),
+    directory=config.get('smtp_metrics_dir') or os.path.join(config['data_dir'], 'smtp_metrics'),
+)
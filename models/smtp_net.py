@@ -0,0 +1,250 @@
+"""DNS and TLS session caches of the outbound SMTP connections.
+
+:class:`CachedSMTP` and :class:`CachedSMTP_SSL` are drop-in ``smtplib`` clients
+that resolve the server through :data:`resolver_cache` and negotiate TLS
+through :data:`tls_session_cache`, so reconnecting to a server neither repeats
+the DNS lookup while its answer is valid nor the full TLS handshake when the
+server accepts to resume the previous session.
+
+The configured hosts are smarthosts, so they are resolved to A/AAAA records
+(no MX lookup) by ``getaddrinfo``, which honours ``/etc/hosts`` and nsswitch.
+When ``dnspython`` is installed, the answer is cached for the TTL of the DNS
+records of the host, read within the connect timeout, as long as they hold
+one of the addresses ``getaddrinfo`` returned; otherwise for
+``DNS_DEFAULT_TTL``. Failed lookups are cached ``DNS_NEGATIVE_TTL``.
+"""
+import ipaddress
+import smtplib
+import socket
+import ssl
+import threading
+import time
+
+try:
+    import dns.resolver
+except ImportError:
+    dns = None
+
+DNS_DEFAULT_TTL = 300
+DNS_NEGATIVE_TTL = 60
+# seconds allowed to read the TTL when no connect timeout is given
+DNS_TTL_TIMEOUT = 5
+
+
+class ResolverCache(object):
+    """TTL-honouring cache of ``socket.getaddrinfo`` answers, including failures."""
+
+    def __init__(self, default_ttl=DNS_DEFAULT_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # (host, port) -> (expiry, addrinfos or gaierror)
+        self.lookups = 0
+        self.lookups_saved = 0
+
+    def resolve(self, host, port, timeout=None):
+        """Return the ``getaddrinfo`` entries of ``host``, raising ``socket.gaierror``
+        (possibly from the cache) when it cannot be resolved. The TTL lookup
+        takes at most ``timeout`` seconds."""
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            return socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self.lookups_saved += 1
+                if isinstance(entry[1], socket.gaierror):
+                    raise entry[1]
+                return entry[1]
+            self.lookups += 1
+        try:
+            result = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            ttl = self._ttl(host, {info[4][0] for info in result}, timeout)
+        except socket.gaierror as e:
+            result, ttl = e, self.negative_ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, result)
+        if isinstance(result, socket.gaierror):
+            raise result
+        return result
+
+    def _ttl(self, host, addresses, timeout=None):
+        """Return the smallest TTL of the A/AAAA records of ``host`` holding one
+        of ``addresses``, ``default_ttl`` when there is none (``/etc/hosts``
+        entry, no ``dnspython``, no answer within ``timeout`` seconds)."""
+        if dns is None:
+            return self.default_ttl
+        if not isinstance(timeout, (int, float)) or not timeout:
+            # no timeout, or socket._GLOBAL_DEFAULT_TIMEOUT
+            timeout = DNS_TTL_TIMEOUT
+        deadline = time.monotonic() + timeout
+        ttls = []
+        for rdtype in ('A', 'AAAA'):
+            lifetime = deadline - time.monotonic()
+            if lifetime <= 0:
+                break
+            try:
+                answer = dns.resolver.resolve(host, rdtype, raise_on_no_answer=False, lifetime=lifetime)
+            except Exception:
+                continue
+            if answer.rrset is not None and addresses & {record.address for record in answer.rrset}:
+                ttls.append(answer.rrset.ttl)
+        return min(ttls) if ttls else self.default_ttl
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'lookups': self.lookups, 'lookups_saved': self.lookups_saved, 'entries': len(self._entries)}
+
+
+class TLSSessionCache(object):
+    """One shared ``ssl.SSLContext`` per server, with the last TLS session
+    negotiated with it, offered for resumption on the next connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contexts = {}
+        self._sessions = {}
+        self.handshakes = 0
+        self.resumed = 0
+
+    def context(self, host, port):
+        with self._lock:
+            context = self._contexts.get((host, port))
+            if context is None:
+                # same (unverified) context as smtplib uses by default
+                context = self._contexts[(host, port)] = ssl._create_stdlib_context()
+            return context
+
+    def wrap(self, sock, host, port):
+        """Negotiate TLS on ``sock``, resuming the last session of the server if any."""
+        context = self.context(host, port)
+        with self._lock:
+            session = self._sessions.get((host, port))
+        try:
+            ssl_sock = context.wrap_socket(sock, server_hostname=host, session=session)
+        except ssl.SSLError:
+            if session is None:
+                raise
+            # the server refused the resumption attempt in a way we cannot recover from
+            self.forget(host, port)
+            raise
+        with self._lock:
+            self.handshakes += 1
+            if ssl_sock.session_reused:
+                self.resumed += 1
+        self.remember(ssl_sock, host, port)
+        return ssl_sock
+
+    def remember(self, ssl_sock, host, port):
+        """Keep the session of ``ssl_sock``. With TLS 1.3 the session ticket only
+        arrives after the handshake, so this is called again before closing."""
+        try:
+            session = ssl_sock.session
+        except (ValueError, OSError):
+            session = None
+        if session is not None and (session.has_ticket or session.id):
+            with self._lock:
+                self._sessions[(host, port)] = session
+
+    def forget(self, host, port):
+        with self._lock:
+            self._sessions.pop((host, port), None)
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+            self._sessions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'handshakes': self.handshakes, 'resumed': self.resumed, 'sessions': len(self._sessions)}
+
+
+resolver_cache = ResolverCache()
+tls_session_cache = TLSSessionCache()
+
+
+def to_prometheus():
+    """Return the counters of both caches in the Prometheus text exposition format.
+    The caches belong to the process, so are their counters."""
+    dns_stats = resolver_cache.stats()
+    tls_stats = tls_session_cache.stats()
+    return '\n'.join([
+        '# HELP smtp_dns_lookups_total DNS lookups of SMTP servers, by result.',
+        '# TYPE smtp_dns_lookups_total counter',
+        'smtp_dns_lookups_total{result="resolved"} %d' % dns_stats['lookups'],
+        'smtp_dns_lookups_total{result="cached"} %d' % dns_stats['lookups_saved'],
+        '# HELP smtp_tls_handshakes_total TLS handshakes with SMTP servers, by kind.',
+        '# TYPE smtp_tls_handshakes_total counter',
+        'smtp_tls_handshakes_total{kind="full"} %d' % (tls_stats['handshakes'] - tls_stats['resumed']),
+        'smtp_tls_handshakes_total{kind="resumed"} %d' % tls_stats['resumed'],
+    ]) + '\n'
+
+
+def create_connection(host, port, timeout, source_address=None):
+    """``socket.create_connection`` going through :data:`resolver_cache`."""
+    error = None
+    for _family, _type, _proto, _canonname, sockaddr in resolver_cache.resolve(host, port, timeout):
+        try:
+            return socket.create_connection(sockaddr[:2], timeout, source_address)
+        except OSError as e:
+            error = e
+    raise error or OSError("getaddrinfo returns an empty list")
+
+
+class CachedSMTP(smtplib.SMTP):
+    """``smtplib.SMTP`` using the DNS cache and resuming TLS sessions on STARTTLS."""
+
+    _port = None
+
+    def _get_socket(self, host, port, timeout):
+        self._port = port
+        return create_connection(host, port, timeout, self.source_address)
+
+    def starttls(self, keyfile=None, certfile=None, context=None):
+        """Same as ``smtplib.SMTP.starttls``, negotiating TLS through the session cache."""
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("starttls"):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        (resp, reply) = self.docmd("STARTTLS")
+        if resp != 220:
+            raise smtplib.SMTPResponseException(resp, reply)
+        self.sock = tls_session_cache.wrap(self.sock, self._host, self._port)
+        # RFC 3207: the client MUST discard any knowledge obtained from the server
+        self.file = None
+        self.helo_resp = None
+        self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return (resp, reply)
+
+    def close(self):
+        if isinstance(self.sock, ssl.SSLSocket):
+            tls_session_cache.remember(self.sock, self._host, self._port)
+        super().close()
+
+
+class CachedSMTP_SSL(smtplib.SMTP_SSL):
+    """``smtplib.SMTP_SSL`` using the DNS cache and resuming TLS sessions."""
+
+    _port = None
+
+    def _get_socket(self, host, port, timeout):
+        self._port = port
+        sock = create_connection(host, port, timeout, self.source_address)
+        return tls_session_cache.wrap(sock, self._host, port)
+
+    def close(self):
+        if isinstance(self.sock, ssl.SSLSocket):
+            tls_session_cache.remember(self.sock, self._host, self._port)
+        super().close()
@@ -0,0 +1,228 @@
+"""File spool of the messages a mail server temporarily refused.
+
+The spool is enabled by the ``smtp_spool_dir`` option of the server
+configuration file, each database gets its own spool in a sub-directory named
+after it. Each message is stored once, as the serialized RFC 5322
+bytes, in ``messages/<id>.eml``; its envelope and delivery state live in
+``journal.jsonl``, a write-ahead journal of JSON lines replayed to know what is
+left to deliver::
+
+    {"op": "add", "id": ..., "server": 3, "message_id": ..., "from": ..., "to": [...], "attempts": 0, "next_try": ...}
+    {"op": "retry", "id": ..., "attempts": 1, "next_try": ..., "error": ...}
+    {"op": "done", "id": ...}
+    {"op": "failed", "id": ..., "error": ...}
+
+Additions are synced right away, as the message is then considered sent by
+``mail.mail``; the outcomes of the delivery runs are buffered and synced every
+``fsync_batch`` lines. Message files are only removed once their outcome is
+synced, so a crash can at worst deliver a message twice, never lose it.
+Several processes may share the spool, the accesses to the journal are
+serialized with ``flock`` on ``spool.lock``.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+SPOOL_FSYNC_BATCH = 50
+# same as smtp_customize.STREAM_CHUNK_SIZE, without importing the models
+SPOOL_CHUNK_SIZE = 57 * 1024
+
+
+class SmtpSpool(object):
+
+    def __init__(self, directory, fsync_batch=SPOOL_FSYNC_BATCH):
+        self.directory = directory
+        self.messages_dir = os.path.join(directory, 'messages')
+        self.failed_dir = os.path.join(directory, 'failed')
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self.lock_path = os.path.join(directory, 'spool.lock')
+        self.fsync_batch = fsync_batch
+        self._lock = threading.Lock()
+        self._pending = []  # journal lines not synced yet
+        self._unlink = []  # (path, destination or None) once the pending lines are synced
+        os.makedirs(self.messages_dir, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def message_path(self, entry_id):
+        return os.path.join(self.messages_dir, '%s.eml' % entry_id)
+
+    def has_message(self, entry):
+        return os.path.exists(self.message_path(entry['id']))
+
+    def add(self, data, server_id, message_id, smtp_from, smtp_to_list, next_try):
+        """Store the message ``data`` and return its spool id, once both the
+        message and its journal entry are on disk."""
+        entry_id = uuid.uuid4().hex
+        path = self.message_path(entry_id)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        entry = {
+            'op': 'add', 'id': entry_id, 'server': server_id or False, 'message_id': message_id, 'from': smtp_from,
+            'to': list(smtp_to_list), 'attempts': 0, 'next_try': next_try, 'size': len(data),
+        }
+        with self._lock:
+            self._pending.append(entry)
+            self._flush()
+        return entry_id
+
+    def retry(self, entry, next_try, error, attempt=True):
+        self._record({
+            'op': 'retry', 'id': entry['id'], 'attempts': entry['attempts'] + (1 if attempt else 0),
+            'next_try': next_try, 'error': error,
+        })
+
+    def done(self, entry):
+        self._record({'op': 'done', 'id': entry['id']}, (self.message_path(entry['id']), None))
+
+    def fail(self, entry, error):
+        destination = os.path.join(self.failed_dir, '%s.eml' % entry['id'])
+        self._record({'op': 'failed', 'id': entry['id'], 'error': error},
+                     (self.message_path(entry['id']), destination))
+
+    def _record(self, line, unlink=None):
+        with self._lock:
+            self._pending.append(line)
+            if unlink:
+                self._unlink.append(unlink)
+            if len(self._pending) >= self.fsync_batch:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        data = ''.join(json.dumps(line, separators=(',', ':')) + '\n' for line in self._pending).encode()
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.journal_path, 'a+b') as f:
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        # end the line torn by a crashed process
+                        data = b'\n' + data
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self._pending = []
+        for path, destination in self._unlink:
+            try:
+                if destination:
+                    os.rename(path, destination)
+                else:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._unlink = []
+
+    def _replay(self):
+        entries = {}
+        lines = 0
+        try:
+            f = open(self.journal_path)
+        except FileNotFoundError:
+            return entries, lines
+        with f:
+            for raw in f:
+                lines += 1
+                try:
+                    line = json.loads(raw)
+                except ValueError:
+                    # line torn by a crashed process
+                    continue
+                if line['op'] == 'add':
+                    entries[line['id']] = line
+                elif line['op'] == 'retry' and line['id'] in entries:
+                    entries[line['id']].update(attempts=line['attempts'], next_try=line['next_try'],
+                                               error=line.get('error'))
+                elif line['op'] in ('done', 'failed'):
+                    entries.pop(line['id'], None)
+        return entries, lines
+
+    def entries(self):
+        """Return the messages left to deliver, by spool id."""
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            return self._replay()[0]
+
+    def due(self, now=None):
+        """Return the messages whose next try is due, oldest first."""
+        now = time.time() if now is None else now
+        return sorted((entry for entry in self.entries().values() if entry['next_try'] <= now),
+                      key=lambda entry: entry['next_try'])
+
+    def compact(self):
+        """Rewrite the journal with one line per message left to deliver, when
+        it mostly holds the history of delivered ones."""
+        with self._lock:
+            self._flush()
+            with open(self.lock_path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries, lines = self._replay()
+                if lines <= 2 * len(entries) + self.fsync_batch:
+                    return
+                for entry in entries.values():
+                    entry['op'] = 'add'
+                tmp_path = self.journal_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.writelines(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries.values())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_path, self.journal_path)
+                directory = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(directory)
+                finally:
+                    os.close(directory)
+        _logger.info('SMTP spool journal compacted from %d to %d lines', lines, len(entries))
+
+    def iter_data(self, entry, chunk_size=SPOOL_CHUNK_SIZE):
+        """Yield the DATA bytes of a spooled message: CRLF line endings, lines
+        starting with a dot escaped with another dot, by chunks of about
+        ``chunk_size`` bytes. The final ``.`` line is not included."""
+        chunk = []
+        size = 0
+        with open(self.message_path(entry['id']), 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\r\n')
+                if line.startswith(b'.'):
+                    line = b'.' + line
+                chunk.append(line + b'\r\n')
+                size += len(line) + 2
+                if size >= chunk_size:
+                    yield b''.join(chunk)
+                    chunk = []
+                    size = 0
+        if chunk:
+            yield b''.join(chunk)
+
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool(dbname):
+    """Return the spool of database ``dbname``, None when the ``smtp_spool_dir``
+    option is not set."""
+    directory = config.get('smtp_spool_dir')
+    if not directory:
+        return None
+    directory = os.path.join(directory, dbname)
+    with _spools_lock:
+        spool = _spools.get(directory)
+        if spool is None:
+            spool = _spools[directory] = SmtpSpool(directory)
+        return spool
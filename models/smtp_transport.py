@@ -0,0 +1,370 @@
+"""asyncio SMTP transport, an alternative to the blocking ``smtplib`` backend.
+
+:class:`AsyncSMTPClient` speaks the client side of SMTP (EHLO, STARTTLS, AUTH
+PLAIN/LOGIN and pipelined MAIL/RCPT/DATA) on asyncio streams.
+
+:class:`AsyncSMTPConnection` wraps one client behind the subset of the
+``smtplib.SMTP`` API used by Odoo, running it on a shared background loop, so
+that it can be returned by ``SmtpConfiguration._connect``. The calling thread
+waits for each command, so the transport brings the timeouts of
+``AsyncSMTPClient`` (notably the total one), not more concurrency than the
+threads sending the mails.
+
+Errors are raised as the ``smtplib`` exceptions (and ``socket.timeout``) so
+callers handle both backends the same way.
+
+The transport requires Python 3.7 (``MIN_PYTHON``), the first version whose
+event loop can upgrade a connection to TLS (``loop.start_tls``) for STARTTLS.
+"""
+import asyncio
+import base64
+import logging
+import re
+import smtplib
+import socket
+import ssl
+import sys
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+MIN_PYTHON = (3, 7)
+
+CRLF = b'\r\n'
+_dot_stuffing = re.compile(br'(?m)^\.')
+_eol = re.compile(br'\r\n|\r|\n')
+
+
+def _quote_data(data):
+    """Normalize line endings to CRLF and dot-stuff ``data`` for the DATA command."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    data = _dot_stuffing.sub(b'..', _eol.sub(CRLF, data))
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data
+
+
+class AsyncSMTPClient(object):
+    """Client side of one SMTP session on asyncio streams.
+
+    :param float connect_timeout: seconds allowed to open the TCP (and SSL) connection
+    :param float read_timeout: seconds allowed to wait for each server reply
+    :param float total_timeout: seconds allowed for the whole session, 0 for no limit
+    """
+
+    def __init__(self, host, port, use_ssl=False, connect_timeout=60, read_timeout=60,
+                 total_timeout=0, local_hostname=None, debug=False):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.local_hostname = local_hostname or socket.getfqdn()
+        self.debug = debug
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        self.helo_sent = False
+        self._reader = self._writer = None
+        # writer of the plain transport, kept alive once replaced by the TLS one:
+        # writers close their transport when garbage collected
+        self._plain_writer = None
+        self._deadline = None
+
+    def _timeout(self, timeout):
+        if self._deadline is None:
+            return timeout
+        remaining = self._deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('SMTP session total timeout exceeded')
+        return min(timeout, remaining) if timeout else remaining
+
+    async def _wait(self, awaitable, timeout):
+        try:
+            return await asyncio.wait_for(awaitable, self._timeout(timeout))
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out')
+
+    async def connect(self):
+        if self.total_timeout:
+            self._deadline = time.monotonic() + self.total_timeout
+        context = ssl._create_stdlib_context() if self.use_ssl else None
+        self._reader, self._writer = await self._wait(asyncio.open_connection(
+            self.host, self.port, ssl=context, server_hostname=self.host if context else None,
+        ), self.connect_timeout)
+        code, message = await self.getreply()
+        if code != 220:
+            await self.close()
+            raise smtplib.SMTPConnectError(code, message)
+        return code, message
+
+    async def putcmd(self, cmd, args=''):
+        line = '%s %s' % (cmd, args) if args else cmd
+        if self.debug:
+            _logger.debug('send: %r', line)
+        await self.send(line.encode('ascii') + CRLF)
+
+    async def send(self, data):
+        if self._writer is None:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        self._writer.write(data)
+        try:
+            await self._wait(self._writer.drain(), self.read_timeout)
+        except ConnectionError as e:
+            await self.close()
+            raise smtplib.SMTPServerDisconnected('Server not connected: %s' % e)
+
+    async def getreply(self):
+        lines = []
+        while True:
+            line = await self._wait(self._reader.readline(), self.read_timeout)
+            if not line:
+                await self.close()
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            if self.debug:
+                _logger.debug('reply: %r', line)
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-' or code == -1:
+                return code, b'\n'.join(lines)
+
+    async def docmd(self, cmd, args=''):
+        await self.putcmd(cmd, args)
+        return await self.getreply()
+
+    async def ehlo(self):
+        code, message = await self.docmd('ehlo', self.local_hostname)
+        self.esmtp_features = {}
+        if code != 250:
+            return code, message
+        self.does_esmtp = True
+        self.helo_sent = True
+        for line in message.decode('latin-1').split('\n')[1:]:
+            feature, _sep, params = line.partition(' ')
+            self.esmtp_features[feature.lower()] = params.strip()
+        return code, message
+
+    async def helo(self):
+        code, message = await self.docmd('helo', self.local_hostname)
+        self.helo_sent = code == 250
+        return code, message
+
+    async def ehlo_or_helo_if_needed(self):
+        if self.helo_sent:
+            return
+        if not (200 <= (await self.ehlo())[0] <= 299):
+            code, message = await self.helo()
+            if not (200 <= code <= 299):
+                raise smtplib.SMTPHeloError(code, message)
+
+    def has_extn(self, name):
+        return name.lower() in self.esmtp_features
+
+    async def starttls(self):
+        await self.ehlo_or_helo_if_needed()
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.')
+        code, message = await self.docmd('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+        context = ssl._create_stdlib_context()
+        if hasattr(self._writer, 'start_tls'):
+            await self._wait(self._writer.start_tls(context, server_hostname=self.host), self.connect_timeout)
+        else:
+            # Python < 3.11: upgrade the transport, the reader keeps being fed by
+            # the same protocol, only the writer has to target the TLS transport
+            loop = asyncio.get_event_loop()
+            protocol = self._writer.transport.get_protocol()
+            transport = await self._wait(loop.start_tls(
+                self._writer.transport, protocol, context, server_hostname=self.host,
+            ), self.connect_timeout)
+            self._plain_writer = self._writer
+            self._writer = asyncio.StreamWriter(transport, protocol, self._reader, loop)
+        # RFC 3207: forget everything learnt before the TLS negotiation
+        self.esmtp_features = {}
+        self.does_esmtp = self.helo_sent = False
+        return code, message
+
+    async def login(self, user, password):
+        await self.ehlo_or_helo_if_needed()
+        if not self.has_extn('auth'):
+            raise smtplib.SMTPNotSupportedError('SMTP AUTH extension not supported by server.')
+        mechanisms = self.esmtp_features['auth'].upper().split()
+        if 'PLAIN' in mechanisms:
+            token = base64.b64encode(('\0%s\0%s' % (user, password)).encode('utf-8')).decode('ascii')
+            code, message = await self.docmd('AUTH', 'PLAIN ' + token)
+        elif 'LOGIN' in mechanisms:
+            code, message = await self.docmd('AUTH', 'LOGIN ' + base64.b64encode(user.encode('utf-8')).decode('ascii'))
+            if code == 334:
+                code, message = await self.docmd(base64.b64encode(password.encode('utf-8')).decode('ascii'))
+        else:
+            raise smtplib.SMTPException('No suitable authentication method found.')
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+        return code, message
+
+    async def noop(self):
+        return await self.docmd('noop')
+
+    async def mail(self, sender, options=()):
+        return await self.docmd('mail', 'FROM:<%s>%s' % (sender, ''.join(' ' + o for o in options)))
+
+    async def rcpt(self, recipient):
+        return await self.docmd('rcpt', 'TO:<%s>' % recipient)
+
+    async def data(self, msg):
+        code, message = await self.docmd('data')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, message)
+        await self.send(_quote_data(msg) + b'.' + CRLF)
+        return await self.getreply()
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """Send one message, pipelining MAIL FROM and the RCPT TO commands when
+        the server advertises PIPELINING. Raises like ``smtplib.SMTP.sendmail``
+        and returns the refused recipients."""
+        await self.ehlo_or_helo_if_needed()
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        options = []
+        if self.has_extn('size'):
+            options.append('size=%d' % len(msg))
+        if self.has_extn('pipelining'):
+            await self.putcmd('mail', 'FROM:<%s>%s' % (from_addr, ''.join(' ' + o for o in options)))
+            for recipient in to_addrs:
+                await self.putcmd('rcpt', 'TO:<%s>' % recipient)
+            code, message = await self.getreply()
+            replies = [(await self.getreply()) for _recipient in to_addrs]
+        else:
+            code, message = await self.mail(from_addr, options)
+            replies = []
+            if code == 250:
+                replies = [(await self.rcpt(recipient)) for recipient in to_addrs]
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPSenderRefused(code, message, from_addr)
+        refused = {recipient: reply for recipient, reply in zip(to_addrs, replies) if reply[0] not in (250, 251)}
+        if len(refused) == len(to_addrs):
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, message = await self.data(msg)
+        if code != 250:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, message)
+        return refused
+
+    async def rset(self):
+        try:
+            return await self.docmd('rset')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def quit(self):
+        try:
+            return await self.docmd('quit')
+        finally:
+            await self.close()
+
+    async def close(self):
+        writer, self._reader, self._writer = self._writer, None, None
+        if writer is not None:
+            writer.close()
+        self._plain_writer = None
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Return the event loop shared by the asyncio connections of this process,
+    running forever in a daemon thread."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='smtp-asyncio', daemon=True).start()
+        return _loop
+
+
+def run(coroutine):
+    """Run ``coroutine`` on the shared loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+class AsyncSMTPConnection(object):
+    """Blocking facade over :class:`AsyncSMTPClient` exposing the methods of
+    ``smtplib.SMTP`` that Odoo uses, so it can stand in for it."""
+
+    def __init__(self, host, port, use_ssl=False, connect_timeout=60, read_timeout=60, total_timeout=0):
+        if sys.version_info < MIN_PYTHON:
+            raise smtplib.SMTPException('The asyncio SMTP transport requires Python %d.%d or later.' % MIN_PYTHON)
+        self.client = AsyncSMTPClient(host, port, use_ssl=use_ssl, connect_timeout=connect_timeout,
+                                      read_timeout=read_timeout, total_timeout=total_timeout)
+        run(self.client.connect())
+
+    @property
+    def esmtp_features(self):
+        return self.client.esmtp_features
+
+    def set_debuglevel(self, debuglevel):
+        self.client.debug = bool(debuglevel)
+
+    def has_extn(self, name):
+        return self.client.has_extn(name)
+
+    def ehlo(self, name=''):
+        return run(self.client.ehlo())
+
+    def ehlo_or_helo_if_needed(self):
+        return run(self.client.ehlo_or_helo_if_needed())
+
+    def starttls(self):
+        return run(self.client.starttls())
+
+    def login(self, user, password):
+        return run(self.client.login(user, password))
+
+    def noop(self):
+        return run(self.client.noop())
+
+    def mail(self, sender, options=()):
+        return run(self.client.mail(sender, options))
+
+    def rcpt(self, recip, options=()):
+        return run(self.client.rcpt(recip))
+
+    def putcmd(self, cmd, args=''):
+        return run(self.client.putcmd(cmd, args))
+
+    def getreply(self):
+        return run(self.client.getreply())
+
+    def docmd(self, cmd, args=''):
+        return run(self.client.docmd(cmd, args))
+
+    def send(self, data):
+        return run(self.client.send(data))
+
+    def data(self, msg):
+        return run(self.client.data(msg))
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        return run(self.client.sendmail(from_addr, to_addrs, msg.encode('utf-8') if isinstance(msg, str) else msg))
+
+    def send_message(self, msg, from_addr=None, to_addrs=None, mail_options=(), rcpt_options=()):
+        return self.sendmail(from_addr or msg['From'], to_addrs or msg.get_all('To', []), msg.as_bytes())
+
+    def rset(self):
+        return run(self.client.rset())
+
+    def quit(self):
+        return run(self.client.quit())
+
+    def close(self):
+        return run(self.client.close())
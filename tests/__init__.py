@@ -0,0 +1,2 @@
+from . import test_build_email_merge
+from . import test_from_policy
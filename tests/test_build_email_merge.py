@@ -0,0 +1,90 @@
+from unittest.mock import patch
+
+from odoo.tests import common, tagged
+
+HTML_BODY = '<div><p>Hello <b>world</b>,</p><p>.a line starting with a dot</p></div>'
+ATTACHMENTS = [('report.pdf', b'%PDF-1.4 fake' * 100, 'application/pdf'), ('notes.txt', b'some notes', 'text/plain')]
+DATE = 'Sat, 17 Oct 2026 12:00:00 -0000'
+
+
+@tagged('post_install', '-at_install')
+class TestBuildEmailMerge(common.TransactionCase):
+
+    def setUp(self):
+        super(TestBuildEmailMerge, self).setUp()
+        self.IrMailServer = self.env['ir.mail_server']
+        # runs of recipients sharing the same set of headers are copied from the
+        # first message of the run, the others are built from scratch
+        self.recipients = [
+            {'email_to': ['alice@example.com'], 'message_id': '<merge-1@example.com>'},
+            {'email_to': ['bob@example.com'], 'message_id': '<merge-2@example.com>'},
+            {'email_to': ['"Carol C." <carol@example.com>'], 'message_id': '<merge-3@example.com>'},
+            {'email_to': ['dave@example.com'], 'email_cc': ['cc1@example.com'], 'message_id': '<merge-4@example.com>'},
+            {'email_to': ['erin@example.com'], 'email_cc': ['cc2@example.com'], 'message_id': '<merge-5@example.com>'},
+            {'email_to': ['frank@example.com'], 'email_cc': ['cc1@example.com', 'cc2@example.com'],
+             'message_id': '<merge-6@example.com>'},
+            {'email_to': ['grace@example.com'], 'message_id': '<merge-7@example.com>', 'references': '<ref@example.com>'},
+            {'email_to': ['heidi@example.com'], 'message_id': '<merge-8@example.com>', 'headers': {'X-Campaign': '42'}},
+            {'email_to': ['ivan@example.com'], 'message_id': '<merge-9@example.com>'},
+        ]
+        self.built_from_scratch = 5
+
+    def _as_bytes(self, message):
+        """Serialize ``message`` with fixed MIME boundaries and Date."""
+        for index, part in enumerate(message.walk()):
+            if part.is_multipart():
+                part.set_boundary('=boundary-%d=' % index)
+        message.replace_header('Date', DATE)
+        return message.as_bytes()
+
+    def _count_build_email(self):
+        """Patch ``ir.mail_server._build_email`` to count the messages built from
+        scratch, return the patcher and the list of the calls."""
+        calls = []
+        build_email = type(self.IrMailServer)._build_email
+
+        def _build_email(model, *args, **kwargs):
+            calls.append(kwargs.get('email_to'))
+            return build_email(model, *args, **kwargs)
+        return patch.object(type(self.IrMailServer), '_build_email', _build_email), calls
+
+    def _build_email(self, recipient):
+        return self.IrMailServer.build_email(
+            'sender@example.com', recipient['email_to'], 'Newsletter', HTML_BODY,
+            email_cc=recipient.get('email_cc'), message_id=recipient['message_id'],
+            references=recipient.get('references'), headers=recipient.get('headers'),
+            subtype='html', attachments=ATTACHMENTS)
+
+    def test_build_email_merge_bytes(self):
+        patcher, calls = self._count_build_email()
+        with patcher:
+            merged = self.IrMailServer.build_email_merge(
+                self.recipients, 'sender@example.com', 'Newsletter', HTML_BODY, subtype='html',
+                attachments=ATTACHMENTS)
+        self.assertEqual(len(merged), len(self.recipients))
+        self.assertEqual(len(calls), self.built_from_scratch,
+                         'The recipients sharing the headers of the previous one must be copied from it')
+        for recipient, message in zip(self.recipients, merged):
+            self.assertEqual(self._as_bytes(message), self._as_bytes(self._build_email(recipient)),
+                             'Merged message of %s differs from build_email()' % recipient['email_to'])
+
+    def test_build_email_merge_context(self):
+        """build_email() calls sharing the ``build_email_merge`` context state, as
+        done by mail.mail, give the same bytes as independent calls, even when
+        the caller alters the message it gets."""
+        IrMailServer = self.IrMailServer.with_context(build_email_merge={})
+        built = 0
+        for recipient in self.recipients:
+            patcher, calls = self._count_build_email()
+            with patcher:
+                message = IrMailServer.build_email(
+                    'sender@example.com', recipient['email_to'], 'Newsletter', HTML_BODY,
+                    email_cc=recipient.get('email_cc'), message_id=recipient['message_id'],
+                    references=recipient.get('references'), headers=recipient.get('headers'),
+                    subtype='html', attachments=ATTACHMENTS)
+            built += len(calls)
+            expected = self._as_bytes(self._build_email(recipient))
+            self.assertEqual(self._as_bytes(message), expected)
+            del message['To']
+        self.assertEqual(built, self.built_from_scratch,
+                         'The recipients sharing the headers of the previous one must be copied from it')
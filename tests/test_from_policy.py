@@ -0,0 +1,77 @@
+from odoo.tests import common, tagged
+
+from ..models.smtp_customize import (
+    FromPolicy, email_domain_extract, encapsulate_email, extract_rfc2822_addresses,
+)
+
+SENDERS = [
+    'admin@example.com',
+    '"Admin" <admin@example.com>',
+    'Admin <admin@example.com>',
+    '"Dupont, Jean" <jean.dupont@other.org>',
+    '"Zoé" <zoe@other.org>',
+    'someone@catchall.example.com',
+    '"Someone" <someone@catchall.example.com>',
+    '"Someone" <someone@Catchall.Example.com>',
+    # malformed
+    '',
+    'not an address',
+    '"No address" <>',
+    '<admin@example.com',
+    'admin@',
+    '@example.com',
+    'a@b@example.com',
+    None,
+]
+
+CONFIGURATIONS = [
+    # force
+    ('notifications@example.com', False, False),
+    ('"Notifications" <notifications@example.com>', 'bounce@catchall.example.com', 'catchall.example.com'),
+    ('not an address', False, False),
+    # dynamic
+    (False, 'bounce@catchall.example.com', 'catchall.example.com'),
+    (False, '"Bounce" <bounce@catchall.example.com>', 'catchall.example.com'),
+    (False, 'not an address', 'catchall.example.com'),
+    # pass-through
+    (False, False, False),
+    (False, 'bounce@catchall.example.com', False),
+    (False, False, 'catchall.example.com'),
+]
+
+
+def get_email_from(email_from, force_smtp_from, dynamic_smtp_from, catchall_domain):
+    """``ir.mail_server._get_email_from`` as it was before FromPolicy."""
+    if force_smtp_from:
+        rfc2822_force_smtp_from = extract_rfc2822_addresses(force_smtp_from)
+        rfc2822_force_smtp_from = rfc2822_force_smtp_from[0] if rfc2822_force_smtp_from else None
+        return encapsulate_email(email_from, force_smtp_from), rfc2822_force_smtp_from
+
+    elif dynamic_smtp_from and catchall_domain and email_domain_extract(email_from) != catchall_domain:
+        rfc2822_dynamic_smtp_from = extract_rfc2822_addresses(dynamic_smtp_from)
+        rfc2822_dynamic_smtp_from = rfc2822_dynamic_smtp_from[0] if rfc2822_dynamic_smtp_from else None
+        return encapsulate_email(email_from, dynamic_smtp_from), rfc2822_dynamic_smtp_from
+
+    return email_from, None
+
+
+@tagged('post_install', '-at_install')
+class TestFromPolicy(common.TransactionCase):
+
+    def test_rewrite(self):
+        for configuration in CONFIGURATIONS:
+            policy = FromPolicy(*configuration)
+            for email_from in SENDERS:
+                with self.subTest(configuration=configuration, email_from=email_from):
+                    expected = get_email_from(email_from, *configuration)
+                    self.assertEqual(policy.rewrite(email_from), expected)
+                    # memoized
+                    self.assertEqual(policy.rewrite(email_from), expected)
+
+    def test_rewrite_many(self):
+        for configuration in CONFIGURATIONS:
+            with self.subTest(configuration=configuration):
+                senders = SENDERS + SENDERS[::-1]
+                self.assertEqual(
+                    FromPolicy(*configuration).rewrite_many(senders),
+                    [get_email_from(email_from, *configuration) for email_from in senders])
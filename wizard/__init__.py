@@ -0,0 +1 @@
+from . import smtp_metrics_report
@@ -0,0 +1,49 @@
+from odoo import fields, models, _
+from odoo.tools import html_escape as escape
+
+from ..models.smtp_metrics import metrics
+
+
+class SmtpMetricsReport(models.TransientModel):
+    _name = 'smtp.metrics.report'
+    _description = 'SMTP Send Metrics'
+
+    enabled = fields.Boolean('Instrumentation Enabled', default=lambda self: metrics.enabled, readonly=True)
+    report = fields.Html('Stages', compute='_compute_report', sanitize=False)
+
+    def _compute_report(self):
+        rows = ''.join(
+            '<tr><td>%s</td><td>%s</td><td>%s</td><td class="text-right">%d</td>'
+            '<td class="text-right">%.1f</td><td class="text-right">%s</td><td class="text-right">%s</td></tr>' % (
+                escape(line['stage']), escape(line['server']), escape(line['user']), line['count'],
+                line['avg'] * 1000, _format_bound(line['p50']), _format_bound(line['p99']))
+            for line in metrics.summary()
+        )
+        byte_rows = ''.join(
+            '<tr><td>%s</td><td>%s</td><td class="text-right">%d</td></tr>' % (escape(server), escape(user), nbytes)
+            for (server, user), nbytes in metrics.bytes_summary()
+        )
+        report = (
+            '<table class="table table-sm"><thead><tr><th>%s</th><th>%s</th><th>%s</th><th class="text-right">%s</th>'
+            '<th class="text-right">%s</th><th class="text-right">%s</th><th class="text-right">%s</th></tr></thead>'
+            '<tbody>%s</tbody></table>'
+            '<table class="table table-sm"><thead><tr><th>%s</th><th>%s</th><th class="text-right">%s</th></tr></thead>'
+            '<tbody>%s</tbody></table>' % (
+                _('Stage'), _('Server'), _('User'), _('Count'), _('Avg (ms)'), _('p50 (ms)'), _('p99 (ms)'), rows,
+                _('Server'), _('User'), _('Bytes Sent'), byte_rows)
+        )
+        for wizard in self:
+            wizard.report = report
+
+    def action_reset(self):
+        metrics.reset()
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+
+def _format_bound(seconds):
+    return '&gt; 60000' if seconds == float('inf') else '&lt;= %g' % (seconds * 1000)